@@ -25,7 +25,7 @@
 //                          Global Defines
 #define MAX_CMD 3
 #define MAX_INST 10
-#define NCOMMANDS 15
+#define NCOMMANDS 17
 #define MAX_MSG_LEN 40
 //#define LED_BUILTIN 26          // this isn't the case on the Node32s, is it?
 #define LEDARR_PIN 26 //22
@@ -93,8 +93,8 @@ int *INST[MAX_INST]; //Maximum number of possible instructions =
 std::vector<int> INSTS;
 std::string CMDS;
 
-const char *COMMANDSET[NCOMMANDS] = {"NA", "PXL", "HLINE", "VLINE", "RECT", "CIRC", "LEFT", "RIGHT", "TOP", "BOTTOM", "CLEAR", "PRESET", "SETPRE", "FLYBY", "ALIVE"};
-const char *INSTRUCTS[NCOMMANDS] = {"1", "4", "4", "4", "8", "6", "3", "3", "3", "3", "0", "1", "1", "1", "1"};
+const char *COMMANDSET[NCOMMANDS] = {"NA", "PXL", "HLINE", "VLINE", "RECT", "CIRC", "LEFT", "RIGHT", "TOP", "BOTTOM", "CLEAR", "PRESET", "SETPRE", "FLYBY", "ALIVE", "SWAP", "PATTERN"};
+const char *INSTRUCTS[NCOMMANDS] = {"1", "4", "4", "4", "8", "6", "3", "3", "3", "3", "0", "1", "1", "1", "1", "5", "-1"}; // -1: any number
 
 // ----------------------------------------------------------------------------------------------------------------
 //                          Additional Functions
@@ -359,6 +359,18 @@ void setNA(int select)
     }
 }
 
+// set a single pixel of the active pattern, without updating the display
+void setPatternPixel(int idx, int r, int g, int b)
+{
+  int xpos = idx % ncols;
+  int ypos = idx / ncols;
+  matrix->drawPixel(xpos, ypos, matrix->Color(r, g, b));
+  light_pattern_bool[xpos][ypos][activePattern] = true;
+  light_pattern_color[xpos][ypos][activePattern][0] = r;
+  light_pattern_color[xpos][ypos][activePattern][1] = g;
+  light_pattern_color[xpos][ypos][activePattern][2] = b;
+}
+
 void updateColor(uint8_t r, uint8_t g, uint8_t b)
 {
   rgb.r = r;
@@ -432,6 +444,7 @@ void callback(char *topic, byte* message, unsigned int length)
       else if (strcmp(CMD, COMMANDSET[10]) == 0) // CLEAR
         {
           clearPattern();
+          client.publish(stopicSTATUS.c_str(), "CLEAR DONE");
         }
       else if (strcmp(CMD, COMMANDSET[11]) == 0)
         {
@@ -452,6 +465,36 @@ void callback(char *topic, byte* message, unsigned int length)
         {
           Serial.print("alive!");
         }
+      else if (strcmp(CMD, COMMANDSET[15]) == 0) // SWAP+from+to+r+g+b
+        {
+          // turn off one pixel and turn on another with a single display update
+          // and a single ack, instead of two PXL round trips.
+          updateColor(INSTS[nINST - 3], INSTS[nINST - 2], INSTS[nINST - 1]);
+          setPatternPixel(INSTS[0], 0, 0, 0);
+          setPatternPixel(INSTS[1], rgb.r, rgb.g, rgb.b);
+          matrix->show();
+          client.publish(stopicSTATUS.c_str(), "SWAP DONE");
+        }
+      else if (strcmp(CMD, COMMANDSET[16]) == 0) // PATTERN+r+g+b+idx+idx+...
+        {
+          // light exactly the given pixels (everything else off) with a single
+          // display update and a single ack, for multiplexed illumination.
+          updateColor(INSTS[0], INSTS[1], INSTS[2]);
+          matrix->clear();
+          for (int xpos = 0; xpos < ncols; xpos++)
+            {
+              for (int ypos = 0; ypos < nrows; ypos++)
+                {
+                  light_pattern_bool[xpos][ypos][activePattern] = false;
+                }
+            }
+          for (int i = 3; i < nINST; i++)
+            {
+              setPatternPixel(INSTS[i], rgb.r, rgb.g, rgb.b);
+            }
+          matrix->show();
+          client.publish(stopicSTATUS.c_str(), "PATTERN DONE");
+        }
       else
         {
           Serial.print("CMD not found.");
@@ -556,7 +599,8 @@ void setup()
 //                          LOOP
 void loop()
 {
-  uc2wait(1000);
+  // no wait here: incoming commands are only handled in client.loop(), so any
+  // delay adds directly to the led switching latency.
   if (!client.connected())
     {
       reconnect();
@@ -240,6 +240,7 @@ void callback(char *topic, byte *message, unsigned int length)
         else if (strcmp(CMD, COMMANDSET[2]) == 0)
         {
             stepperZ.step(INSTS[0] *  10);
+            client.publish(stopicSTATUS.c_str(), "DRVZ DONE");
         }
         else if (strcmp(CMD, COMMANDSET[3]) == 0)
         {
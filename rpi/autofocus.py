@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Autofocus with the z-stage, so nobody has to sit at server/focus.py turning
+the stage by hand before a run.
+
+The stage (modules/zstage_esp32) is moved over mqtt with DRVZ commands while
+small preview frames are grabbed from the video port straight into a numpy
+buffer. The sharpness of the central part of each frame is scored, first on a
+coarse sweep over search_range and then with a golden-section search around
+the best coarse position. Every position is approached from below, so the
+stage's backlash is always taken up the same way.
+
+run_fpm.py calls autofocus() before capturing if run_autofocus is set. Run
+this file on its own to just focus (it lights the matrix's center led).
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+
+# ====================================== configure these values ====================================
+zstage_id = "ZSTAGE"
+stage_speed = 10          # rpm, sent with SETSPEED before moving
+steps_per_rev = 2038      # of the z stepper (see stepperZ in the firmware)
+steps_per_unit = 10       # motor steps per DRVZ unit (the firmware multiplies by 10)
+move_ack_margin = 1       # s on top of the expected move time to wait for "DRVZ DONE" (old
+                          # firmware never sends it, then we just wait that long)
+search_range = 200        # DRVZ units searched on either side of where the stage is now
+coarse_step = 25          # DRVZ units between points of the coarse sweep
+tolerance = 2             # DRVZ units (at least 2): the fine search stops at this bracket size
+backlash = 10             # DRVZ units overshot when moving down, to approach from below
+peak_falloff = 0.5        # stop the coarse sweep once the sharpness drops below this fraction of
+                          # the best so far (we're past the focus)
+settle_time = 0.1         # s after a move before grabbing (vibration, frames still in flight)
+focus_exposure = 10000    # us
+focus_resolution = (640, 480) # preview size, the gpu does the decimation
+focus_roi = 0.5           # central fraction of the preview (in each direction) that is scored
+metric = "tenengrad"      # "tenengrad" or "laplacian" (variance of the laplacian)
+# ==================================================================================================
+
+golden = (1 + 5 ** 0.5) / 2
+
+
+def tenengrad(img):
+    """
+    mean squared sobel gradient magnitude.
+    """
+    img = img.astype(np.float32)
+    gx = img[:, 2:] - img[:, :-2] # sobel is separable: a difference one way,
+    gx = gx[:-2] + 2 * gx[1:-1] + gx[2:] # a [1 2 1] smoothing the other
+    gy = img[2:] - img[:-2]
+    gy = gy[:, :-2] + 2 * gy[:, 1:-1] + gy[:, 2:]
+    return float(np.mean(gx * gx + gy * gy))
+
+
+def laplacian_variance(img):
+    img = img.astype(np.float32)
+    laplacian = (img[1:-1, :-2] + img[1:-1, 2:] + img[:-2, 1:-1] + img[2:, 1:-1]
+                 - 4 * img[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def sharpness(img):
+    return tenengrad(img) if metric == "tenengrad" else laplacian_variance(img)
+
+
+def preview_grabber(camera):
+    """
+    a function returning the central focus_roi of a focus_resolution preview's
+    luma, captured from the video port into a reused buffer.
+    """
+    width, height = focus_resolution
+    # the yuv planes are padded to multiples of 32 x 16
+    padded_width, padded_height = -(-width // 32) * 32, -(-height // 16) * 16
+    buf = np.empty(padded_width * padded_height * 3 // 2, dtype=np.uint8)
+    luma = buf[:padded_width * padded_height].reshape(padded_height, padded_width)
+    margin_y = int(height * (1 - focus_roi) / 2)
+    margin_x = int(width * (1 - focus_roi) / 2)
+    roi = luma[margin_y:height - margin_y, margin_x:width - margin_x]
+
+    def grab():
+        camera.shutter_speed = focus_exposure
+        camera.capture(buf, 'yuv', use_video_port=True, resize=focus_resolution)
+        return roi
+    return grab
+
+
+class ZStage:
+    """
+    the z-stage over mqtt. positions are in DRVZ units, relative to where the
+    stage was when this was created.
+    """
+    def __init__(self, client, setup_id):
+        self.client = client
+        self.topic = "/{}/{}/".format(setup_id, zstage_id)
+        self.ack = threading.Event()
+        self.position = 0
+        client.message_callback_add(self.topic + "STAT", self._stat_callback)
+        client.subscribe(self.topic + "STAT")
+        client.publish(self.topic + "RECM", "SETSPEED+{}".format(stage_speed))
+
+    def _stat_callback(self, client, userdata, message):
+        if message.payload == b"DRVZ DONE":
+            self.ack.set()
+
+    def move_to(self, z):
+        if z < self.position: # approach from below
+            self.move(z - backlash - self.position)
+        self.move(z - self.position)
+
+    def move(self, units):
+        """
+        relative move, blocks until the stage is done.
+        """
+        if not units:
+            return
+        self.ack.clear()
+        self.client.publish(self.topic + "RECM", "DRVZ+{}".format(units))
+        expected = abs(units) * steps_per_unit / (steps_per_rev * stage_speed / 60)
+        if not self.ack.wait(expected + move_ack_margin):
+            logging.debug("no ack for DRVZ+{}, assuming it's done".format(units))
+        self.position += units
+
+
+def autofocus(grab, stage):
+    """
+    move stage to the sharpest position within search_range of where it is,
+    and return that position and its sharpness.
+    """
+    scores = {}
+    def score(z):
+        if z not in scores:
+            stage.move_to(z)
+            time.sleep(settle_time)
+            scores[z] = sharpness(grab())
+            logging.debug("focus z={}: {:.1f}".format(z, scores[z]))
+        return scores[z]
+
+    # coarse: one sweep upwards, so there's no backlash between points
+    start = time.time()
+    best = -search_range
+    for z in range(-search_range, search_range + 1, coarse_step):
+        if score(z) > score(best):
+            best = z
+        elif score(z) < peak_falloff * score(best):
+            break
+
+    # fine: golden-section search between the coarse neighbours of best
+    a, b = best - coarse_step, best + coarse_step
+    while b - a > tolerance:
+        c = round(b - (b - a) / golden)
+        d = round(a + (b - a) / golden)
+        if score(c) > score(d):
+            b = d
+        else:
+            a = c
+    best = max(scores, key=scores.get)
+    stage.move_to(best)
+    logging.info("focused at z={} ({} frames, {:.1f}s)".format(
+        best, len(scores), time.time() - start))
+    return best, scores[best]
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.insert(0, "/home/pi/picamera")
+    import picamera
+    import paho.mqtt.client as mqtt
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s :: %(levelname)s :: %(message)s')
+
+    setup_id = "FPMSCOPE"
+    ncols = 8 # of the led matrix
+    client = mqtt.Client("autofocus")
+    client.connect("localhost")
+    client.loop_start()
+    center = (ncols // 2) * ncols + ncols // 2
+    client.publish("/{}/LEDMATRIX/RECM".format(setup_id), "PXL+{}+255+0+0".format(center))
+    with picamera.PiCamera(sensor_mode=0) as camera:
+        camera.analog_gain = 1
+        camera.exposure_mode = 'off'
+        autofocus(preview_grabber(camera), ZStage(client, setup_id))
+    client.publish("/{}/LEDMATRIX/RECM".format(setup_id), "CLEAR")
+    client.loop_stop()
@@ -33,20 +33,69 @@ logging.info("using picamera from (make sure it's the git repo): {}".format(pica
 logging.info("using picamera.array from (make sure it's the git repo): {}".format(picamera.array.__file__))
 
 import time
+import zlib
+import struct
+import queue
+import threading
+import json
+import http.client
+import urllib.parse
 import paho.mqtt.client as mqtt
 import numpy as np
 from PIL import Image
 
+import autofocus
+
 # ====================================== configure these values ====================================
 mqtt_host_ip = "localhost"
 mqtt_client_id = "pi"
 setup_id = "FPMSCOPE"
 ledmatrix_id = "LEDMATRIX"
+camera_id = "CAMERA"                   # server listens on /setup_id/camera_id/FILE for new captures
 ledmatrix_pxl_count = 64
 exposure_times = [1000, 5000, 10000, 100000, 100000] # in us
 analog_gain = 1                        # 1--highest read noise, highest dynamic range
 digital_gain = 1
 base_folder_path = "/var/www/" # probably what you want if you're hosting these files on a webserver.
+raw_format = "packed"  # "packed": 12-bit 2d mosaic (.pb12, see server/packed_bayer.py), ~4x smaller
+                       # "npy": PiBayerArray.array as is (h x w x 3 uint16)
+manifest_name = "manifest.txt"  # every finished capture is appended here too (fallback for the server)
+run_id = os.environ.get("FPM_RUN_ID") or time.strftime("%Y%m%d%H%M%S") # set by the server, tags
+                       # every manifest line and FILE message so it can tell this run's from old ones
+run_info_name = "run_info.json" # what this run will capture, so the server knows when an led is complete
+fast_capture = True    # keep the (discarded) jpeg as small and cheap as possible, and save
+                       # frames on a background thread while the next exposure is taken
+fast_capture_resize = (320, 240) # jpeg size in fast capture mode, the bayer data is always full size
+led_ack_timeout = 1   # s to wait for the led matrix to acknowledge a command before resending
+led_ack_retries = 3
+use_led_swap = True   # switch leds with one SWAP command (needs the current matrix firmware)
+write_queue_size = 4   # frames waiting to be saved before capture blocks (ram: ~72MB each)
+multiplex = 1          # leds lit together in each dark-field frame (1 = one led per frame). the
+                       # frames are named img{pattern}_{exposure}us, and run_info.json has the
+                       # leds of every pattern for the server to demultiplex
+multiplex_brightfield_radius = 1.5 # leds closer than this (in led pitches) to the matrix center
+                                   # are still captured one at a time
+adaptive_exposure = None # None: every led at every exposure
+                         # "skip": probe each led once and skip the exposures that would be
+                         #         saturated or too dark to contribute
+                         # "single": only capture the longest exposure that isn't saturated
+adaptive_decimation = 8  # probe statistics use every adaptive_decimation-th 2x2 bayer block
+dark_level = 256         # sensor black level (12-bit)
+saturation_level = 4000  # pixels at or above this count as saturated
+max_saturated = 0.001    # fraction of saturated pixels an exposure may have
+min_signal = 64          # counts above dark_level the brightest 1% must reach to be worth keeping
+roi = None               # (y0, y1, x0, x1) sensor pixels to keep, None = the full sensor. rounded
+                         # out to whole 2x2 bayer blocks, so the bayer order doesn't change
+upload_url = None        # e.g. "http://192.168.1.10:8000/": push every frame to the server
+                         # (file_discovery = 'push' in server/run_fpm.py) and delete it here once
+                         # the server acknowledged its checksum. None = leave it for the server to fetch
+upload_high_water = 2 * 10**9 # bytes of frames waiting for upload before capture blocks
+upload_retry_interval = 2     # s between attempts while the server is unreachable
+run_autofocus = False  # focus with the z-stage on the center led before capturing (see autofocus.py)
+trace = False          # append per-frame timing events (json lines) to trace_name, for
+trace_name = "trace.jsonl" # the server to fetch and report on (see server/tracing.py)
+skip_list_path = "/tmp/fpm_skip.json" # written by the server (see resume in server/run_fpm.py):
+                                      # the frames it already has, which aren't captured again
 # ==================================================================================================
 
 os.chdir(base_folder_path) # need to ensure the user running this script has access! e.g. chown/chmod
@@ -74,63 +123,448 @@ camera.digital_gain = digital_gain
 camera.exposure_mode = 'off'
 start_time = time.time()
 
+def sensor_crop(shape):
+    """
+    roi rounded out to whole 2x2 bayer blocks and clipped to the sensor, as
+    [y0, y1, x0, x1].
+    """
+    if roi is None:
+        return [0, shape[0], 0, shape[1]]
+    y0, y1, x0, x1 = roi
+    return [max(y0 - y0 % 2, 0), min(y1 + y1 % 2, shape[0]),
+            max(x0 - x0 % 2, 0), min(x1 + x1 % 2, shape[1])]
+
+crop = None # from the first frame (the bayer data is always the full sensor)
+
+def illumination_patterns():
+    """
+    the leds lit in each frame. bright-field leds get a frame each, dark-field
+    leds are dealt out over ceil(count / multiplex) frames, so the leds
+    sharing a frame are spread over the matrix.
+    """
+    if multiplex <= 1:
+        return [[i] for i in range(ledmatrix_pxl_count)]
+    ncols = int(round(ledmatrix_pxl_count ** 0.5))
+    center = (ncols - 1) / 2
+    brightfield, darkfield = [], []
+    for i in range(ledmatrix_pxl_count):
+        r = ((i % ncols - center) ** 2 + (i // ncols - center) ** 2) ** 0.5
+        (brightfield if r < multiplex_brightfield_radius else darkfield).append(i)
+    frames = -(-len(darkfield) // multiplex)
+    return [[i] for i in brightfield] + [darkfield[f::frames] for f in range(frames)]
+
+patterns = illumination_patterns()
+logging.info("{} leds in {} frames per exposure".format(ledmatrix_pxl_count, len(patterns)))
+
+run_info = {
+    "run_id": run_id,
+    "led_count": ledmatrix_pxl_count,
+    "exposure_times": sorted(set(exposure_times)), # a repeated exposure overwrites the same file
+    "analog_gain": float(camera.analog_gain),
+    "digital_gain": float(camera.digital_gain),
+    "raw_format": raw_format,
+    "patterns": patterns,
+    "adaptive_exposure": adaptive_exposure,
+    # set once the first frame is in: (height, width) of the full sensor and
+    # the [y0, y1, x0, x1] part of it every frame is
+    "sensor_shape": None,
+    "roi": None,
+}
+if adaptive_exposure is not None:
+    run_info["led_exposures"] = {} # filled in as each led is finished
+
+skip = set() # (pattern, exposure) the server already has
+try:
+    with open(skip_list_path) as f:
+        skip_list = json.load(f)
+    os.remove(skip_list_path) # only good for this run
+    skip = set(tuple(frame) for frame in skip_list["frames"])
+    if adaptive_exposure is not None:
+        # the server has all the exposures these leds were captured at
+        run_info["led_exposures"].update(skip_list["led_exposures"])
+    logging.info("the server already has {} frames, skipping them".format(len(skip)))
+except FileNotFoundError:
+    pass
+
+def write_run_info():
+    # the server may fetch it at any time, so never leave it half written
+    with open(run_info_name + ".tmp", "w") as f:
+        json.dump(run_info, f)
+    os.replace(run_info_name + ".tmp", run_info_name)
+
+write_run_info()
+
+trace_fd = os.open(trace_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND) if trace else None
+
+def trace_event(stage, start, path=None, **fields):
+    """
+    one json line per event, in the format of server/tracing.py. a capture's
+    path adds its led, exposure and size.
+    """
+    if trace_fd is None:
+        return
+    if path is not None:
+        led, exposure = Path(path).stem[3:].split("_") # img{led}_{exposure}us
+        fields.update(led=int(led), exposure=int(exposure[:-2]), bytes=os.path.getsize(path))
+    fields.update(stage=stage, start=start, end=time.time())
+    os.write(trace_fd, (json.dumps(fields) + "\n").encode())
+
 client = mqtt.Client(mqtt_client_id)
 client.connect(mqtt_host_ip)
 ledmatrix_topic = "/{}/{}/".format(setup_id, ledmatrix_id)
+camera_topic = "/{}/{}/".format(setup_id, camera_id)
 _, matrix_stat_mid = client.subscribe(ledmatrix_topic + "STAT")
 if matrix_stat_mid is None:
     logging.critical('error: unable to subscribe to {}STAT'.format(ledmatrix_topic))
     sys.quit()
 
-client.publish(ledmatrix_topic + "RECM" , "CLEAR")
-# TODO: publish some sort of DONE on /STAT when CLEAR completes
-# so we don't have to wait an arbitrary amount of time
-time.sleep(2) 
-
-message_awk = True
-ledmatrix_stat = 1
+matrix_ack = threading.Event()    # set by the matrix's "... DONE" reply
+matrix_online = threading.Event() # cleared while the matrix is disconnected (its will is "0")
+matrix_online.set()
 def ledmatrix_stat_callback(client, userdata, message):
-    global message_awk
-    logging.info("stat_callback: Received message '" + str(message.payload) + "' on topic '"
+    logging.debug("stat_callback: Received message '" + str(message.payload) + "' on topic '"
           + message.topic + "' with QoS " + str(message.qos))
-    if message.payload == b"PXL DONE":
-        message_awk = True
-    elif message.payload = b"0":
-        ledmatrix_stat = 0
-    elif message.payload =b"1":
-        ledmatrix_stat = 1
+    if message.payload in (b"PXL DONE", b"SWAP DONE", b"CLEAR DONE", b"PATTERN DONE"):
+        matrix_ack.set()
+    elif message.retain:
+        pass # a stale online/offline status from before we connected
+    elif message.payload == b"0":
+        logging.warning("led matrix went offline, waiting for it to come back...")
+        matrix_online.clear()
+    elif message.payload == b"1":
+        matrix_online.set()
+
+def send_and_wait(command, retries=led_ack_retries):
+    """
+    publish a command to the led matrix and block until it is acknowledged,
+    resending it if no ack arrives within led_ack_timeout (or the matrix
+    reconnected in the meantime). returns the round trip time in s.
+    """
+    for attempt in range(retries + 1):
+        matrix_online.wait()
+        matrix_ack.clear()
+        start = time.perf_counter()
+        client.publish(ledmatrix_topic + "RECM", command)
+        if matrix_ack.wait(led_ack_timeout):
+            return time.perf_counter() - start
+        logging.warning("no ack for {} after {}s".format(command, led_ack_timeout))
+    raise TimeoutError("led matrix did not acknowledge {}".format(command))
 
 def set_led_and_wait(i, rgb):
-    global message_awk
-    if message_awk == False:
-        logging.critical("message_awk is False, so a message is already in progress.")
-        raise ValueError("message_awk is False, so a message is already in progress.")
-    message_awk = False
-    client.publish(ledmatrix_topic + "RECM", "PXL+{}+{}+{}+{}".format(i, *rgb))
-    while not message_awk:
-        if ledmatrix_stat = 0:
-            while not ledmatrix_stat:
-                time.sleep(0.1)
-            client.publish(ledmatrix_topic + "RECM", "PXL+{}+{}+{}+{}".format(i, *rgb))
-        time.sleep(0.1)
+    return send_and_wait("PXL+{}+{}+{}+{}".format(i, *rgb))
+
+def switch_led(prev, i, rgb):
+    """
+    turn off led prev (if not None) and turn on led i, with a single SWAP
+    command and ack if the firmware supports it. logs and returns the latency.
+    """
+    if prev is None:
+        latency = set_led_and_wait(i, rgb)
+    elif use_led_swap:
+        latency = send_and_wait("SWAP+{}+{}+{}+{}+{}".format(prev, i, *rgb))
+    else:
+        latency = set_led_and_wait(prev, (0, 0, 0)) + set_led_and_wait(i, rgb)
+    logging.info("led switch {} -> {}: {:.1f} ms".format(prev, i, latency * 1000))
+    return latency
+
+def show_pattern(prev, pattern, rgb):
+    """
+    switch from the leds in prev (None at the start) to the leds in pattern.
+    single leds use switch_led, anything else a PATTERN command (or a PXL per
+    led with old firmware).
+    """
+    if len(pattern) == 1 and (prev is None or len(prev) == 1):
+        return switch_led(None if prev is None else prev[0], pattern[0], rgb)
+    if use_led_swap:
+        latency = send_and_wait("PATTERN+{}+{}+{}+".format(*rgb) + "+".join(map(str, pattern)))
+    else:
+        latency = sum(set_led_and_wait(i, (0, 0, 0)) for i in prev or [])
+        for i in pattern:
+            latency += set_led_and_wait(i, rgb)
+    logging.info("led pattern {} -> {}: {:.1f} ms".format(prev, pattern, latency * 1000))
+    return latency
 
 def on_message(client, userdata, message):
     logging.info("fallback on_message: Received message '" + str(message.payload) + "' on topic '"
           + message.topic + "' with QoS " + str(message.qos))
-    
+
 client.message_callback_add(ledmatrix_topic + "STAT", ledmatrix_stat_callback)
 client.on_message = on_message
 client.loop_start()
+
+try:
+    send_and_wait("CLEAR", retries=0)
+except TimeoutError:
+    logging.warning("no ack for CLEAR (old matrix firmware?), continuing anyway")
+
+def write_sidecar(path):
+    """
+    write "<size> <crc32>" to path.crc, so the server can check its download.
+    """
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+    with open(path + ".crc", "w") as f:
+        f.write("{} {:08x}\n".format(os.path.getsize(path), crc))
+
+def bayer_order(bayer_array):
+    """
+    colors of the top left 2x2 block, read off which channel is used at each
+    position in (a corner of) the PiBayerArray.
+    """
+    corner = bayer_array[:64, :64]
+    return "".join("RGB"[np.argmax(corner[y::2, x::2].reshape(-1, 3).sum(axis=0))]
+                   for y in (0, 1) for x in (0, 1))
+
+def pack12(mosaic):
+    # keep in sync with server/packed_bayer.py
+    pairs = mosaic.reshape(-1, 2)
+    packed = np.empty((pairs.shape[0], 3), dtype=np.uint8)
+    packed[:, 0] = pairs[:, 0] & 0xff
+    packed[:, 1] = (pairs[:, 0] >> 8) | ((pairs[:, 1] & 0xf) << 4)
+    packed[:, 2] = pairs[:, 1] >> 4
+    return packed
+
+def save_packed(path, bayer_array, order, exposure_time):
+    """
+    save the bayer data as a 12-bit packed 2d mosaic with a small header
+    (see server/packed_bayer.py for the layout).
+    """
+    mosaic = bayer_array.sum(axis=2, dtype=np.uint16) # only one channel is nonzero per pixel
+    height, width = mosaic.shape
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sB4sIIIffH", b"PB12", 1, order.encode(), height, width,
+                            exposure_time, float(camera.analog_gain),
+                            float(camera.digital_gain), 0))
+        f.write(pack12(mosaic).tobytes())
+
+def announce_file(path):
+    """
+    mark a capture as finished. Besides the .done marker (used by the server's
+    html index scraper) the file is appended to the manifest and published on
+    the camera FILE topic (both as "<run_id> <path>"), so the server can start
+    downloading right away.
+    """
+    write_sidecar(path)
+    Path(path).with_suffix(".done").touch()
+    with open(manifest_name, "a") as f:
+        f.write("{} {}\n".format(run_id, path))
+    client.publish(camera_topic + "FILE", "{} {}".format(run_id, path), qos=1)
+    if upload_url is not None:
+        global pending_bytes
+        with pending_cond:
+            pending_bytes += os.path.getsize(path)
+        upload_queue.put(path)
+
+pending_bytes = 0 # saved but not uploaded yet
+pending_cond = threading.Condition()
+
+def upload_file(path):
+    """
+    PUT path to upload_url along with its crc32. True once the server
+    acknowledged the same size and crc (see server/receiver.py).
+    """
+    with open(path + ".crc") as f:
+        size, crc = f.read().split()
+    url = urllib.parse.urlsplit(upload_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    try:
+        with open(path, "rb") as f: # streamed, not read into memory
+            conn.request("PUT", url.path.rstrip("/") + "/" + urllib.parse.quote(path), body=f,
+                         headers={"Content-Length": size, "X-CRC32": crc})
+        response = conn.getresponse()
+        ack = response.read().decode().split()
+    finally:
+        conn.close()
+    return response.status == 200 and ack == [size, crc]
+
+def uploader():
+    """
+    push files from upload_queue until a None is received. Each one is
+    retried until the server has it, and only then deleted here.
+    """
+    global pending_bytes
+    while True:
+        path = upload_queue.get()
+        if path is None:
+            return
+        start = time.time()
+        while True:
+            try:
+                if upload_file(path):
+                    break
+                logging.warning("server rejected {}, resending".format(path))
+            except OSError as e:
+                logging.warning("could not upload {} ({}), retrying...".format(path, e))
+            time.sleep(upload_retry_interval)
+        trace_event("upload", start, path)
+        size = os.path.getsize(path)
+        for done_path in (path, path + ".crc", str(Path(path).with_suffix(".done"))):
+            os.remove(done_path)
+        with pending_cond:
+            pending_bytes -= size
+            pending_cond.notify_all()
+
+def wait_for_space():
+    with pending_cond:
+        if pending_bytes >= upload_high_water:
+            logging.info("{} bytes waiting for upload, pausing capture".format(pending_bytes))
+        pending_cond.wait_for(lambda: pending_bytes < upload_high_water)
+
+def save_frame(name, bayer_array, exposure_time):
+    global order
+    start = time.time()
+    if raw_format == "packed":
+        if order is None:
+            order = bayer_order(bayer_array)
+            logging.info("bayer order: {}".format(order))
+        path = name + ".pb12"
+        save_packed(path, bayer_array, order, exposure_time)
+    else:
+        path = name + ".npy"
+        np.save(path, bayer_array)
+    # before announcing: once the uploader has it, it may be gone any moment
+    trace_event("save", start, path)
+    announce_file(path)
+
+def decimate(bayer_array):
+    """
+    every adaptive_decimation-th 2x2 block of the mosaic, all four sites.
+    """
+    step = 2 * adaptive_decimation
+    return np.stack([bayer_array[y::step, x::step].max(axis=2)
+                     for y in (0, 1) for x in (0, 1)]).ravel()
+
+def plan_exposures(sample, exposure_time, candidates):
+    """
+    the candidate exposures worth capturing, predicted from a decimated frame
+    taken at exposure_time assuming the sensor is linear: the saturated
+    fraction and the brightest 1% (above dark_level) are scaled to each
+    candidate at once. None if the frame itself is too saturated to predict
+    from, so a shorter exposure has to be probed first.
+    """
+    if (np.mean(sample >= saturation_level) > max_saturated
+            and exposure_time > min(candidates)):
+        return None
+    signal = np.sort(np.maximum(sample.astype(np.float32) - dark_level, 0))
+    scale = np.float32(candidates) / exposure_time
+    saturated = 1 - np.searchsorted(signal, (saturation_level - dark_level) / scale) / len(signal)
+    bright = signal[int(0.99 * (len(signal) - 1))] * scale
+    unsaturated = saturated <= max_saturated
+    if not unsaturated.any():
+        return [min(candidates)]
+    if adaptive_exposure == "single":
+        return [int(max(np.array(candidates)[unsaturated]))]
+    useful = unsaturated & (bright >= min_signal)
+    if not useful.any(): # all too dark, the longest one is the best we can do
+        return [int(max(np.array(candidates)[unsaturated]))]
+    return [int(e) for e in np.array(candidates)[useful]]
+
+def frame_writer():
+    """
+    save frames from write_queue until a None is received.
+    """
+    while True:
+        frame = write_queue.get()
+        if frame is None:
+            return
+        try:
+            save_frame(*frame)
+        except Exception:
+            logging.exception("could not save {}".format(frame[0]))
+
 logging.info("ag: {}\t dg: {}".format(camera.analog_gain, camera.digital_gain))
-for pxl_idx in range(ledmatrix_pxl_count):
+order = None # bayer order, found from the first capture
+if fast_capture:
+    # the bayer data only comes attached to a still jpeg, but that jpeg can be tiny
+    capture_options = {'resize': fast_capture_resize, 'quality': 1, 'thumbnail': None}
+    write_queue = queue.Queue(maxsize=write_queue_size)
+    writer = threading.Thread(target=frame_writer)
+    writer.start()
+else:
+    capture_options = {}
+if upload_url is not None:
+    upload_queue = queue.Queue()
+    upload_thread = threading.Thread(target=uploader)
+    upload_thread.start()
+
+def capture(output, exposure_time, pxl_idx):
+    if upload_url is not None:
+        wait_for_space()
+    start = time.time()
+    camera.shutter_speed = exposure_time
+    camera.capture(output, 'jpeg', bayer=True, **capture_options)
+    trace_event("capture", start, led=pxl_idx, exposure=exposure_time)
+    # every capture assigns a new output.array, so it's safe to hand off
+    bayer_array = output.array
+    global crop
+    if crop is None:
+        crop = sensor_crop(bayer_array.shape)
+        logging.info("keeping sensor pixels {}".format(crop))
+        run_info["sensor_shape"] = list(bayer_array.shape[:2])
+        run_info["roi"] = crop
+        write_run_info()
+    return bayer_array[crop[0]:crop[1], crop[2]:crop[3]]
+
+def keep_frame(pxl_idx, bayer_array, exposure_time):
+    frame = ("img{}_{}us".format(pxl_idx, exposure_time), bayer_array, exposure_time)
+    if fast_capture:
+        write_queue.put(frame) # blocks if the writer falls behind
+    else:
+        save_frame(*frame)
+    logging.info("{}u exposure complete.".format(exposure_time))
+
+exposures = run_info["exposure_times"]
+probe_exposure = exposures[len(exposures) // 2] # neighbouring leds are similar, so
+prev_pattern = None                             # later leds probe at the last choice
+if run_autofocus:
+    ncols = int(round(ledmatrix_pxl_count ** 0.5))
+    focus_led = (ncols // 2) * ncols + ncols // 2
+    show_pattern(None, [focus_led], (255, 0, 0))
+    prev_pattern = [focus_led]
+    autofocus.autofocus(autofocus.preview_grabber(camera), autofocus.ZStage(client, setup_id))
+for pxl_idx, pattern in enumerate(patterns):
+    if adaptive_exposure is None:
+        todo = [e for e in exposures if (pxl_idx, e) not in skip]
+    else:
+        todo = [] if str(pxl_idx) in run_info["led_exposures"] else exposures
+    if not todo:
+        logging.info("skipping pxl {}, the server has it".format(pxl_idx))
+        continue
     with picamera.array.PiBayerArray(camera) as output:
-        logging.info("starting pxl {}...".format(pxl_idx))
-        set_led_and_wait(pxl_idx, (255, 0, 0))
-        for exposure_time in exposure_times:
-            camera.shutter_speed = exposure_time
-            camera.capture(output, 'jpeg', bayer=True)
-            np.save("img{}_{}us".format(pxl_idx, exposure_time), output.array)
-            logging.info("{}u exposure complete.".format(exposure_time))
-            Path("img{}_{}us.done".format(pxl_idx, exposure_time)).touch()
-        set_led_and_wait(pxl_idx, (0, 0, 0))
+        logging.info("starting pxl {} (leds {})...".format(pxl_idx, pattern))
+        start = time.time()
+        show_pattern(prev_pattern, pattern, (255, 0, 0))
+        trace_event("led", start, led=pxl_idx)
+        prev_pattern = pattern
+        if adaptive_exposure is None:
+            for exposure_time in todo:
+                keep_frame(pxl_idx, capture(output, exposure_time, pxl_idx), exposure_time)
+            continue
+        chosen = None
+        while chosen is None:
+            probe = capture(output, probe_exposure, pxl_idx)
+            chosen = plan_exposures(decimate(probe), probe_exposure, exposures)
+            if chosen is None:
+                probe_exposure = max(e for e in exposures if e < probe_exposure)
+        logging.info("pxl {}: capturing at {}".format(pxl_idx, chosen))
+        for exposure_time in chosen:
+            if exposure_time == probe_exposure:
+                keep_frame(pxl_idx, probe, exposure_time)
+            else:
+                keep_frame(pxl_idx, capture(output, exposure_time, pxl_idx), exposure_time)
+        probe_exposure = chosen[len(chosen) // 2]
+        run_info["led_exposures"][str(pxl_idx)] = chosen
+        write_run_info()
+if prev_pattern is not None:
+    for i in prev_pattern:
+        set_led_and_wait(i, (0, 0, 0))
+if fast_capture:
+    write_queue.put(None)
+    writer.join()
+if upload_url is not None:
+    logging.info("waiting for the last uploads...")
+    upload_queue.put(None)
+    upload_thread.join()
 logging.info("finished in: {}s".format(time.time() - start_time))
@@ -0,0 +1,465 @@
+"""
+Offline benchmarks of the capture pipeline, so a change can be measured
+without the pi, the camera, the led matrix or a network.
+
+Everything runs on this machine:
+ - the capture script (rpi/run_fpm.py) runs as is, with a fake picamera
+   producing synthetic 12-bit bayer frames and a fake paho mqtt client whose
+   led matrix acks every command after led_ack_latency,
+ - a local http server stands in for the pi's apache,
+ - server/run_fpm.py, dataset.py and image_cleanup.py are the real thing.
+
+Benchmarks:
+ - transfer:          sync_new_files / download_and_process of ready captures
+ - load_dataset:      image_cleanup.load_dataset of a whole dataset container,
+                      reading every pixel
+ - load_files:        the same for a directory of tiffs (save_as = 'files' in
+                      run_fpm.py, .npy captures), i.e. without a container
+ - demosaic_channel:  one full (height, width, 3) bayer array
+ - batch_hdr:         opencv hdr merge of every led (calibrating the response)
+ - capture_to_tiff:   run_fpm.main(), from starting the capture to the last
+                      processed tiff
+
+    python benchmark.py [benchmark ...] [--size HxW] [--leds N] [--output path]
+
+Every run appends one json line (config, git commit, results) to output_path,
+so results can be compared across commits.
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import tifffile as tiff
+
+import dataset
+import image_cleanup
+import packed_bayer
+import run_fpm
+
+# ================================== CONFIG ===================================
+image_size = (760, 1014)     # (height, width) of the synthetic sensor (the IMX477 is 3040 x 4056)
+led_count = 16
+exposure_times = [1000, 5000, 10000, 100000] # us
+led_ack_latency = 0.005      # s the fake led matrix takes to ack a command
+simulate_exposure = True     # the fake camera takes as long as the shutter is open
+repeats = 3                  # runs of each micro benchmark, min and median are reported
+benchmarks = ['transfer', 'load_dataset', 'load_files', 'demosaic_channel', 'batch_hdr',
+              'capture_to_tiff']
+output_path = 'benchmark_results.jsonl'
+pi_script_path = Path(__file__).resolve().parent.parent / 'rpi' / 'run_fpm.py'
+# =============================================================================
+
+dark_level = 256
+
+
+def synthetic_mosaic(shape, exposure, seed=0):
+    """
+    a 12-bit bayer mosaic (with dark level) of a smooth random scene, about
+    half full at 10ms.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((shape[0] // 32 + 2, shape[1] // 32 + 2), dtype=np.float32)
+    scene = np.kron(coarse, np.ones((32, 32), dtype=np.float32))[:shape[0], :shape[1]]
+    counts = scene * (exposure / 10000 * 2000) + dark_level
+    return np.clip(counts, 0, 4095).astype(np.uint16)
+
+
+def mosaic_to_bayer_array(mosaic):
+    """
+    (height, width, 3) like PiBayerArray.array: BGGR, one channel per pixel.
+    """
+    array = np.zeros(mosaic.shape + (3,), dtype=np.uint16)
+    for (y, x), channel in zip([(0, 0), (0, 1), (1, 0), (1, 1)], [2, 1, 1, 0]):
+        array[y::2, x::2, channel] = mosaic[y::2, x::2]
+    return array
+
+
+# ------------------------------- fake pi -------------------------------------
+
+class FakeCamera:
+    """
+    enough of picamera.PiCamera for the capture script. Frames are made once
+    per exposure and copied for every capture, like the real camera hands
+    out a new array each time.
+    """
+    def __init__(self, sensor_mode=0):
+        self.analog_gain = 1
+        self.digital_gain = 1
+        self.exposure_mode = 'auto'
+        self.shutter_speed = 0
+        self.frames = {}
+
+    def capture(self, output, format=None, bayer=False, **options):
+        if self.shutter_speed not in self.frames:
+            self.frames[self.shutter_speed] = mosaic_to_bayer_array(
+                synthetic_mosaic(image_size, self.shutter_speed))
+        if simulate_exposure:
+            time.sleep(self.shutter_speed / 1e6)
+        output.array = self.frames[self.shutter_speed].copy()
+
+    def close(self):
+        pass
+
+
+class FakeBayerArray:
+    def __init__(self, camera):
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+        self.qos = 0
+        self.retain = False
+
+
+class FakeMqttClient:
+    """
+    in-process stand-in for paho's Client and the broker: commands published
+    to the led matrix are acked on its STAT topic after led_ack_latency,
+    everything else goes nowhere.
+    """
+    acked = ('PXL', 'SWAP', 'CLEAR', 'PATTERN')
+
+    def __init__(self, client_id=None):
+        self.callbacks = {}
+        self.on_message = None
+
+    def connect(self, host, port=1883):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        return 0, 1
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload, qos=0):
+        if not topic.endswith('/LEDMATRIX/RECM'):
+            return
+        command = str(payload).split('+')[0]
+        if command in self.acked:
+            stat_topic = topic[:-len('RECM')] + 'STAT'
+            timer = threading.Timer(led_ack_latency, self._deliver,
+                                    (stat_topic, command + ' DONE'))
+            timer.daemon = True
+            timer.start()
+
+    def _deliver(self, topic, payload):
+        callback = self.callbacks.get(topic, self.on_message)
+        if callback is not None:
+            callback(self, None, FakeMessage(topic, payload))
+
+
+def install_fake_pi_modules():
+    picamera = types.ModuleType('picamera')
+    picamera.__file__ = __file__ # the capture script logs where picamera came from
+    picamera.PiCamera = FakeCamera
+    picamera.array = types.ModuleType('picamera.array')
+    picamera.array.__file__ = __file__
+    picamera.array.PiBayerArray = FakeBayerArray
+    picamera.exc = types.ModuleType('picamera.exc')
+    picamera.exc.PiCameraMMALError = RuntimeError
+    paho = types.ModuleType('paho')
+    paho.mqtt = types.ModuleType('paho.mqtt')
+    paho.mqtt.client = types.ModuleType('paho.mqtt.client')
+    paho.mqtt.client.Client = FakeMqttClient
+    sys.modules.update({
+        'picamera': picamera, 'picamera.array': picamera.array, 'picamera.exc': picamera.exc,
+        'paho': paho, 'paho.mqtt': paho.mqtt, 'paho.mqtt.client': paho.mqtt.client})
+
+
+def run_pi_script(web_root, skip_list_path):
+    """
+    run the capture script against the fakes, writing into web_root/fpm_data.
+    Its config block is executed as is and then overridden, so the script
+    runs unchanged.
+    """
+    install_fake_pi_modules()
+    logging.basicConfig(level=logging.WARNING) # before the script's own, which is then a no-op
+    sys.path.insert(0, str(pi_script_path.parent))
+    source = pi_script_path.read_text()
+    config_end = source.index('\n# ====', source.index('configure these values'))
+    namespace = {'__name__': '__main__', '__file__': str(pi_script_path)}
+    exec(compile(source[:config_end], str(pi_script_path), 'exec'), namespace)
+    namespace.update(
+        ledmatrix_pxl_count=led_count, exposure_times=list(exposure_times),
+        base_folder_path=str(web_root), skip_list_path=str(skip_list_path))
+    # pad so line numbers in tracebacks still match the script
+    tail = '\n' * source[:config_end].count('\n') + source[config_end:]
+    exec(compile(tail, str(pi_script_path), 'exec'), namespace)
+
+
+def fake_connect_and_run_command(web_root, host, username, rsa_psk_path, command, files=None):
+    """
+    what run_fpm.connect_and_run_command does over ssh, locally (including
+    the environment the command sets, e.g. FPM_RUN_ID).
+    """
+    for path, text in (files or {}).items():
+        Path(path).write_text(text)
+    os.environ.update(re.findall(r'(\w+)=(\S+)', command))
+    run_pi_script(web_root, run_fpm.remote_skip_path)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def web_server(root):
+    """
+    serve root over http on a free local port (like the pi's apache: plain
+    files and directory index pages), yields the host:port.
+    """
+    handler = functools.partial(QuietHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield '127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_captures(data_dir, leds, exposures):
+    """
+    ready .pb12 captures (with .crc sidecars and .done markers) like the
+    capture script leaves them. returns their total size.
+    """
+    data_dir.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for exposure in exposures:
+        mosaic = synthetic_mosaic(image_size, exposure)
+        for led in range(leds):
+            path = data_dir / 'img{}_{}us.pb12'.format(led, exposure)
+            packed_bayer.write_packed(path, mosaic, {
+                'bayer_order': 'BGGR', 'exposure': exposure, 'analog_gain': 1.0,
+                'digital_gain': 1.0, 'dark_level': 0})
+            content = path.read_bytes()
+            path.with_name(path.name + '.crc').write_text(
+                '{} {:08x}\n'.format(len(content), zlib.crc32(content)))
+            path.with_suffix('.done').touch()
+            total += len(content)
+    return total
+
+
+def write_dataset(dirname, leds, exposures):
+    dirname.mkdir(parents=True, exist_ok=True)
+    dataset.create_dataset(dirname, bayer_order='BGGR', dark_level=dark_level,
+                           exposure_times=list(exposures))
+    slot = 0
+    for exposure in exposures:
+        mosaic = synthetic_mosaic(image_size, exposure)
+        for led in range(leds):
+            dataset.write_frame(dirname, slot, mosaic)
+            dataset.add_frame(dirname, led, exposure, slot,
+                              height=image_size[0], width=image_size[1])
+            slot += 1
+
+
+def write_tiffs(dirname, leds, exposures):
+    """
+    (height, width, 3) bayer array tiffs like run_fpm.py saves .npy captures
+    in 'files' mode.
+    """
+    dirname.mkdir(parents=True, exist_ok=True)
+    for exposure in exposures:
+        img = mosaic_to_bayer_array(synthetic_mosaic(image_size, exposure))
+        for led in range(leds):
+            tiff.imwrite(dirname / 'img{}_{}us.tiff'.format(led, exposure), img,
+                         **image_cleanup.tiff_options(img))
+
+
+def load_everything(dirname):
+    """
+    image_cleanup.load_dataset, reading every pixel: a container only hands
+    out lazy memmap views, which would otherwise never touch the disk.
+    """
+    data, exposures = image_cleanup.load_dataset(dirname, range(led_count))
+    for imgs in data.values():
+        for img in imgs:
+            np.asarray(img).sum()
+    return data, exposures
+
+
+def timed(func, *args):
+    """
+    (min, median) wall time of repeats runs of func(*args), and its last result.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times)), result
+
+
+# ------------------------------ benchmarks -----------------------------------
+
+def bench_transfer(tmp):
+    web_root = tmp / 'www'
+    nbytes = write_captures(web_root / 'fpm_data', led_count, exposure_times)
+    frames = led_count * len(exposure_times)
+
+    def transfer():
+        local = tmp / 'transfer_{}'.format(time.perf_counter_ns())
+        local.mkdir()
+        dataset.create_dataset(local)
+
+        def on_done(name, result):
+            record, frame = result
+            dataset.add_frame(local, *frame[:3], **frame[3])
+
+        pool = run_fpm.DownloadPool(run_fpm.download_workers, run_fpm.max_pending_downloads,
+                                    on_done=on_done)
+        run_fpm.sync_new_files(host, 'fpm_data', [], str(local), pool)
+        pool.join()
+        if pool.failed:
+            raise RuntimeError("{} downloads failed".format(len(pool.failed)))
+
+    with web_server(web_root) as host:
+        best, median, _ = timed(transfer)
+    return {'frames': frames, 'bytes': nbytes, 'seconds': best, 'median_seconds': median,
+            'frames_per_s': frames / best, 'mb_per_s': nbytes / best / 1e6}
+
+
+def bench_load(dirname):
+    best, median, (data, _) = timed(load_everything, dirname)
+    nbytes = sum(np.asarray(imgs).nbytes for imgs in data.values())
+    return {'frames': led_count * len(exposure_times), 'bytes': nbytes, 'seconds': best,
+            'median_seconds': median, 'mb_per_s': nbytes / best / 1e6}
+
+
+def bench_load_dataset(tmp):
+    write_dataset(tmp / 'dataset', led_count, exposure_times)
+    return bench_load(tmp / 'dataset')
+
+
+def bench_load_files(tmp):
+    write_tiffs(tmp / 'files', led_count, exposure_times)
+    return bench_load(tmp / 'files')
+
+
+def bench_demosaic_channel(tmp):
+    img = mosaic_to_bayer_array(synthetic_mosaic(image_size, 10000))
+    best, median, _ = timed(image_cleanup.demosaic_channel, img, 0)
+    return {'seconds': best, 'median_seconds': median,
+            'mpix_per_s': img.shape[0] * img.shape[1] / best / 1e6}
+
+
+def bench_batch_hdr(tmp):
+    images = [mosaic_to_bayer_array(synthetic_mosaic(image_size, exposure))
+              for exposure in exposure_times]
+    images = [(np.clip(img - dark_level, 0, None) >> 4).astype(np.uint8) for img in images]
+    image_dict = {led: images for led in range(led_count)}
+    best, median, _ = timed(image_cleanup.batch_hdr, image_dict, exposure_times)
+    return {'leds': led_count, 'seconds': best, 'median_seconds': median,
+            'leds_per_s': led_count / best}
+
+
+def bench_capture_to_tiff(tmp):
+    web_root = tmp / 'www_run'
+    web_root.mkdir()
+    local = tmp / 'run'
+    image_cleanup.dest_dir = tmp / 'processed'
+    run_fpm.local_data_dir = str(local)
+    run_fpm.file_discovery = 'manifest'
+    run_fpm.startup_delay = 0
+    run_fpm.remote_skip_path = str(tmp / 'fpm_skip.json')
+    run_fpm.connect_and_run_command = functools.partial(fake_connect_and_run_command, web_root)
+    with web_server(web_root) as host:
+        run_fpm.host = host
+        start = time.perf_counter()
+        run_fpm.main()
+        seconds = time.perf_counter() - start
+    tiffs = len(list(image_cleanup.dest_dir.glob('*.tiff')))
+    frames = len(dataset.FPMDataset(local).slots)
+    if frames != led_count * len(exposure_times) or tiffs != led_count:
+        raise RuntimeError("only {} frames and {} tiffs made it".format(frames, tiffs))
+    return {'frames': frames, 'tiffs': tiffs, 'seconds': seconds,
+            'frames_per_s': frames / seconds}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(names):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            bench = globals()['bench_' + name]
+            (Path(tmp) / name).mkdir()
+            print("{}...".format(name), file=sys.stderr)
+            with contextlib.redirect_stdout(io.StringIO()): # the pipeline is chatty
+                results[name] = bench(Path(tmp) / name)
+            print("  {}".format(results[name]), file=sys.stderr)
+    run = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'config': {'image_size': list(image_size), 'led_count': led_count,
+                   'exposure_times': exposure_times, 'led_ack_latency': led_ack_latency,
+                   'simulate_exposure': simulate_exposure, 'repeats': repeats,
+                   'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    with open(output_path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return run
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="offline pipeline benchmarks")
+    parser.add_argument('benchmarks', nargs='*', help="any of: " + ", ".join(benchmarks))
+    parser.add_argument('--size', help="HxW of the synthetic sensor, e.g. 3040x4056")
+    parser.add_argument('--leds', type=int, help="led count")
+    parser.add_argument('--output', help="json lines file the results are appended to")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(benchmarks)
+    if unknown:
+        parser.error("unknown benchmark(s): {}".format(", ".join(sorted(unknown))))
+    if args.size:
+        image_size = tuple(int(n) for n in args.size.lower().split('x'))
+    if args.leds:
+        led_count = args.leds
+    if args.output:
+        output_path = args.output
+    main(args.benchmarks or benchmarks)
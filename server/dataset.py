@@ -0,0 +1,130 @@
+"""
+Single-file dataset container, so a run doesn't have to be hundreds of small
+files that get globbed and regex-parsed over and over.
+
+A dataset directory holds:
+ - `dataset.raw`: every frame of the run as a (height, width) uint16 bayer
+   mosaic, back to back. Frames are written in whatever order they arrive,
+   each into its own slot, so several processes can fill it at once.
+ - `dataset.json`: metadata (shape, gains, bayer order, dark level already
+   subtracted) and the index of which (led, exposure) is in which slot.
+
+FPMDataset memory-maps the raw file, so indexing it as
+`dataset[led, exposure_idx, y0:y1, x0:x1]` only reads the pixels asked for.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+data_name = 'dataset.raw'
+index_name = 'dataset.json'
+dtype = np.uint16
+
+
+def is_dataset(dirname):
+    return (Path(dirname) / index_name).exists()
+
+
+def create_dataset(dirname, **metadata):
+    """
+    start an empty dataset. metadata (e.g. bayer_order, gains, dark_level) is
+    stored as is, and can be extended by add_frame.
+    """
+    dirname = Path(dirname)
+    open(dirname / data_name, 'wb').close()
+    meta = dict(metadata, frames=[])
+    _write_index(dirname, meta)
+    return meta
+
+
+def write_frame(dirname, slot, mosaic):
+    """
+    write a (height, width) frame into its slot. Slots are handed out by
+    whoever creates the dataset, so concurrent writers never touch the same
+    bytes. The frame only shows up in the index once add_frame is called.
+    """
+    mosaic = np.ascontiguousarray(mosaic, dtype=dtype)
+    with open(Path(dirname) / data_name, 'r+b') as f:
+        f.seek(slot * mosaic.nbytes)
+        f.write(mosaic.tobytes())
+
+
+def add_frame(dirname, led, exposure, slot, **metadata):
+    """
+    add a written frame to the index. metadata (at least height and width)
+    is merged into the dataset's metadata; every frame must have the same
+    shape. A frame that is already there (e.g. fetched again when a run is
+    resumed) replaces its entry. Only one process should call this.
+    """
+    dirname = Path(dirname)
+    meta = json.loads((dirname / index_name).read_text())
+    for key, value in metadata.items():
+        if meta.setdefault(key, value) != value and key in ('height', 'width'):
+            raise ValueError("frame {} {}: {} != {}".format(led, exposure, key, meta[key]))
+    meta['frames'] = [frame for frame in meta['frames'] if frame[:2] != [led, exposure]]
+    meta['frames'].append([led, exposure, slot])
+    _write_index(dirname, meta)
+
+
+def update_metadata(dirname, **metadata):
+    """
+    set dataset-wide metadata (e.g. what the capture script decided while
+    capturing). Like add_frame, only one process should call this.
+    """
+    meta = json.loads((Path(dirname) / index_name).read_text())
+    meta.update(metadata)
+    _write_index(dirname, meta)
+
+
+def _write_index(dirname, meta):
+    # write then rename, so a reader never sees a half written index
+    tmp_path = Path(dirname) / (index_name + '.tmp')
+    tmp_path.write_text(json.dumps(meta, indent=1))
+    tmp_path.replace(Path(dirname) / index_name)
+
+
+class FPMDataset:
+    """
+    lazy reader for a dataset directory. Indexing with
+    [led, exposure_idx, ...] returns a memory-mapped view; exposure_idx
+    indexes the sorted list of exposures.
+    """
+    def __init__(self, dirname):
+        self.dirname = Path(dirname)
+        self.meta = json.loads((self.dirname / index_name).read_text())
+        self.shape = (self.meta.get('height', 0), self.meta.get('width', 0))
+        self.slots = {(led, exposure): slot
+                      for led, exposure, slot in self.meta['frames']}
+        self.leds = sorted(set(led for led, _ in self.slots))
+        self.exposures = sorted(set(exposure for _, exposure in self.slots))
+        frame_count = max(self.slots.values()) + 1 if self.slots else 0
+        if frame_count:
+            self.frames = np.memmap(self.dirname / data_name, dtype=dtype,
+                                    mode='r', shape=(frame_count, *self.shape))
+        else:
+            self.frames = np.empty((0, *self.shape), dtype=dtype)
+
+    @property
+    def led_count(self):
+        return max(self.leds) + 1 if self.leds else 0
+
+    def exposures_of(self, led):
+        """
+        sorted exposures this led was captured at (a subset of exposures if
+        the capture picked them per led).
+        """
+        return sorted(exposure for l, exposure in self.slots if l == led)
+
+    def frame(self, led, exposure):
+        """
+        (height, width) view of one frame, by led index and exposure time (us).
+        """
+        return self.frames[self.slots[(led, exposure)]]
+
+    def __getitem__(self, key):
+        led, exposure_idx, *pixels = key
+        return self.frame(led, self.exposures[exposure_idx])[tuple(pixels)]
+
+    def __contains__(self, key):
+        return key in self.slots
@@ -8,6 +8,9 @@ So make sure that's up and running. same package requirements as the run_fpm
 script.
 
 continuously prints the variance of each band
+
+rpi/autofocus.py does this without anyone at the stage (run_autofocus in
+rpi/run_fpm.py).
 """
 import requests
 import numpy as np
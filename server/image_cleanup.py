@@ -8,16 +8,26 @@ Clean up and check images to make sure they're ready for FPM processing.
 from pathlib import Path
 from datetime import datetime
 import multiprocessing
+import functools
 import re
 from itertools import chain
 import time
+import os
+import tempfile
+import threading
+import queue
+import json
+import weakref
 
 import numpy as np
 import cv2 as cv
 import tifffile as tiff
 from PIL import Image
 import colour_demosaicing
-import psutil
+
+import packed_bayer
+import dataset
+import tracing
 
 # ================================= CONFIG ====================================
 local_data_dir = Path(
@@ -28,38 +38,254 @@ dest_dir = Path(
     "~/Documents/brake_2020_summer/data/in_progress"
 ).expanduser()
 
-as_uint8 = True # convert read images to 8-bit depth? This is needed to run the
-                # devebec script
+as_uint8 = False # convert read images to 8-bit depth? This is needed to run the
+                 # opencv devebec script (hdr_engine = 'opencv')
 run_hdr = False
+hdr_engine = 'numpy' # 'numpy': merge_hdr_stack, whole chunk at once at full bit depth
+                     # 'opencv': MergeDebevec per led (needs as_uint8)
+hdr_response = 'calibrate' # 'calibrate': debevec response curve (cached, see get_response)
+                           # 'linear': raw sensor data is linear, skip calibration (numpy engine only)
+calibration_led = 43 # led whose exposures the response curve is calibrated from
+sensor_bits = 12  # raw bit depth: pixels saturate at 2**sensor_bits - 1 minus the dark level
+dark_level = 256  # already subtracted by server/run_fpm.py (remove_dark_level), only used if the
+                  # dataset container or .pb12 header doesn't say
+response_samples = 500    # pixels sampled for the calibration
+response_smoothness = 10  # weight of the smoothness term in the calibration
+response_cache_dir = Path("~/.cache/uc2_fpm/responses").expanduser()
+sensor = 'IMX477'  # these three key the response cache. gains are read from
+analog_gain = 1    # the dataset container if there is one.
+digital_gain = 1
 exposure_chosen_idx = 3 # only needed if we don't process them together as hdr
 
 chunksize = 22  # pixel image sets to process at once.
+bayer_pattern = 'BGGR' # top left 2x2 block, only for captures that don't record theirs (see
+                       # get_bayer_order)
+demosaic_mode = 'native' # for the channel we keep:
+                         # 'native': only that channel's own pixels (half resolution, no interpolation)
+                         # 'bilinear': full resolution, interpolated like demosaic_channel
+                         # 'full': demosaic_channel on every image (all three channels)
+shared_loading = True # decode images straight into one shared (led, exposure, ...) block
+                      # instead of passing them through a multiprocessing.Manager
+shared_mem_dir = "/dev/shm" # should be a ram backed fs, falls back to the tmp dir
+load_workers = os.cpu_count()
+process_workers = os.cpu_count() # processes for demosaicing/hdr
+memory_budget = 8000000000 # bytes of images (in + out) the workers may hold at once
+prefetch_chunks = 1  # chunks to load ahead while the current one is processed
+write_workers = 2    # threads writing finished tiffs
+max_pending_writes = 2 * chunksize # finished images waiting to be written
+# written tiffs (the processed images, and 'files' captures in run_fpm.py)
+tiff_tile = (256, 256)    # tiles instead of strips, so a roi can be read without the rest of the
+                          # image (see reconstruct.py). None = strips
+tiff_compression = 'zlib' # lossless: 'zlib' (deflate), 'zstd' (needs imagecodecs), None
+tiff_predictor = True     # difference neighbouring pixels before compressing, a lot smaller
+                          # (float images only get one with imagecodecs installed)
+tiff_workers = 4          # threads encoding the tiles of each image
+output_stack = False      # run_pipeline writes one BigTIFF (dest_dir/stack_name), a page per led,
+                          # instead of an img{led}.tiff each. leds processed on worker processes
+                          # (adaptive runs, processing while capturing) still get their own file
+stack_name = "images.tiff"
+trace_path = None    # append trace events (load, demosaic, hdr, write, ...) here, see tracing.py
 # ============================================================================
+frame_name = re.compile(r"img(\d+)_(\d+)us\.(?:tiff|pb12)") # captures, as run_fpm.py saves them
+
+def frame_paths(dirname, pxl='*'):
+    """
+    the captures in dirname (of led pxl), leaving out whatever else a run
+    leaves there (run_info.json, received.txt, .part downloads, ...).
+    """
+    return [path for path in Path(dirname).glob("img{}_*".format(pxl))
+            if frame_name.fullmatch(path.name)]
+
+def read_image(path):
+    """
+    .tiff captures are (height, width, 3) bayer arrays, packed .pb12 captures
+    are unpacked to a 2d (height, width) mosaic.
+    """
+    if Path(path).suffix == '.pb12':
+        return packed_bayer.read_packed(path)[1]
+    return tiff.imread(str(path))
+
 def load_images(dirname, pxl, to_dict, as_uint8=False):
-    paths = Path(dirname).glob("img{}_*".format(pxl))
-    to_dict[pxl] = [
-        tiff.imread(str(path)) for path in sorted(
-            paths,
-            key=lambda x: int( # sort by exposure time
-                re.search(r".*img(\d*)_(\d*)us.*", str(x)).group(2)))
-    ]
+    if dataset.is_dataset(dirname):
+        ds = dataset.FPMDataset(dirname)
+        to_dict[pxl] = [np.array(ds.frame(pxl, e)) for e in ds.exposures_of(pxl)]
+    else:
+        paths = frame_paths(dirname, pxl)
+        to_dict[pxl] = [
+            read_image(path) for path in sorted(
+                paths,
+                key=lambda x: int( # sort by exposure time
+                    re.search(r".*img(\d*)_(\d*)us.*", str(x)).group(2)))
+        ]
     if as_uint8:
         to_dict[pxl] = [(img >> 4).astype(np.uint8) for img in to_dict[pxl]]
 
+def image_shape(path):
+    """
+    shape of an image file, only reading its header.
+    """
+    if Path(path).suffix == '.pb12':
+        with open(path, 'rb') as f:
+            header = packed_bayer.parse_header(f.read(packed_bayer.header_size))
+        return (header['height'], header['width'])
+    with tiff.TiffFile(str(path)) as f:
+        return f.series[0].shape
+
+def _load_into_shared(path, idx, stack_path, stack_shape, dtype, as_uint8):
+    stack = np.memmap(stack_path, dtype=dtype, mode='r+', shape=stack_shape)
+    if as_uint8:
+        stack[idx] = read_image(path) >> 4
+    elif Path(path).suffix == '.pb12':
+        stack[idx] = read_image(path)
+    else: # decode right into the shared block, no intermediate copy
+        tiff.imread(str(path), out=stack[idx])
+    stack.flush()
+
+def load_shared(dirname, indexes=None, as_uint8=False, roi=None):
+    """
+    like load_dataset, but the worker processes decode every image straight
+    into one shared memory-mapped (led, exposure, height, width[, channels])
+    block in shared_mem_dir, so nothing is pickled or copied back. The
+    returned images are views into that block (batch_process's workers map
+    it again by name), it's removed once they're gone.
+    """
+    led_count, exposures = get_img_info(dirname)
+    print("found images for {} leds".format(led_count))
+    print("found {} exposure times: ".format(len(exposures)))
+    [print(e, end="\t") for e in exposures]
+    print("")
+    if indexes == None:
+        indexes = range(led_count)
+    indexes = list(indexes)
+    matcher = re.compile(r".*img(\d*)_(\d*)us.*")
+    tasks = []
+    for led_pos, pxl in enumerate(indexes):
+        for path in frame_paths(dirname, pxl):
+            exposure = int(matcher.search(str(path)).group(2))
+            tasks.append((str(path), (led_pos, exposures.index(exposure))))
+    assert (len(tasks) == len(indexes) * len(exposures))
+    dtype = np.uint8 if as_uint8 else np.uint16
+    stack_shape = (len(indexes), len(exposures)) + tuple(image_shape(tasks[0][0]))
+    if not os.path.isdir(shared_mem_dir):
+        print("WARNING: {} not found, using the tmp dir".format(shared_mem_dir))
+    fd, stack_path = tempfile.mkstemp(
+        suffix='.stack',
+        dir=shared_mem_dir if os.path.isdir(shared_mem_dir) else None)
+    os.close(fd)
+    remove = functools.partial(os.unlink, stack_path)
+    try:
+        stack = np.memmap(stack_path, dtype=dtype, mode='w+', shape=stack_shape)
+        remove = weakref.finalize(stack, os.unlink, stack_path) # once no view is left
+        with multiprocessing.Pool(load_workers) as pool:
+            pool.starmap(_load_into_shared,
+                         [(path, idx, stack_path, stack_shape, dtype, as_uint8)
+                          for path, idx in tasks])
+    except BaseException:
+        remove()
+        raise
+    roi = () if roi is None else (slice(None),) + tuple(roi)
+    return ({pxl: stack[led_pos][roi] for led_pos, pxl in enumerate(indexes)},
+            exposures)
+
 def get_img_info(dirname):
-    paths = list(Path(dirname).glob("*"))
-    matcher = re.compile(".*img(\d*)_(\d*)us.*")
-    matches = [matcher.search(str(path)) for path in paths]
+    if dataset.is_dataset(dirname):
+        ds = dataset.FPMDataset(dirname)
+        return ds.led_count, ds.exposures
+    matches = [frame_name.fullmatch(path.name) for path in frame_paths(dirname)]
     led_count = max([int(m.group(1)) for m in matches]) + 1
     exposures = sorted(list(set([int(m.group(2)) for m in matches])))
     return led_count, exposures
     
-def load_dataset(dirname, indexes=None, as_uint8=False):
+def get_run_info(dirname):
+    """
+    what the capture script recorded about the run: the dataset container's
+    metadata, or the run_info.json next to the captures ({} if neither).
+    """
+    if dataset.is_dataset(dirname):
+        return dataset.FPMDataset(dirname).meta
+    info_path = Path(dirname) / "run_info.json"
+    return json.loads(info_path.read_text()) if info_path.exists() else {}
+
+def get_led_exposures(dirname):
+    """
+    {led: exposures} if the capture picked exposures per led (see
+    adaptive_exposure in rpi/run_fpm.py), otherwise None.
+    """
+    led_exposures = get_run_info(dirname).get('led_exposures')
+    if led_exposures is None:
+        return None
+    return {int(led): exposures for led, exposures in led_exposures.items()}
+
+def get_patterns(dirname):
+    """
+    leds lit in each image of a multiplexed capture (image i is
+    img{i}_...us), from the dataset container or the run_info.json next to
+    the captures. None if each image is a single led.
+    """
+    patterns = get_run_info(dirname).get('patterns')
+    if patterns is None or all(len(leds) == 1 for leds in patterns):
+        return None
+    return patterns
+
+def get_optical_axis(dirname):
+    """
+    (y, x) of the sensor center in the processed images, which is not their
+    center if the pi only kept part of the sensor (see roi in
+    rpi/run_fpm.py). None if the frames are the full sensor.
+    """
+    info = get_run_info(dirname)
+    if info.get('roi') is None or info.get('sensor_shape') is None:
+        return None
+    y0, _, x0, _ = info['roi']
+    axis = np.array(info['sensor_shape']) / 2 - (y0, x0)
+    if demosaic_mode == 'native': # half resolution
+        axis = axis / 2
+    return axis.tolist()
+
+def write_capture_info(dirname):
+    """
+    what reconstruct.py needs to know about the capture, next to the
+    processed images: the leds lit in each image (None unless multiplexed)
+    and where the optical axis is (None = the image center).
+    """
+    (dest_dir / "capture_info.json").write_text(json.dumps({
+        'patterns': get_patterns(dirname),
+        'optical_axis': get_optical_axis(dirname),
+    }))
+
+def load_container(dirname, indexes=None, as_uint8=False, roi=None):
+    """
+    like load_dataset, for a dataset container (see dataset.py). Nothing is
+    read until used: the images are memory-mapped views (unless as_uint8), and
+    with a roi only that part of each frame is ever read.
+    """
+    ds = dataset.FPMDataset(dirname)
+    print("found images for {} leds".format(ds.led_count))
+    print("found {} exposure times: ".format(len(ds.exposures)))
+    [print(e, end="\t") for e in ds.exposures]
+    print("")
+    if indexes == None:
+        indexes = ds.leds
+    roi = () if roi is None else roi
+    loaded_imgs = {}
+    for i in indexes:
+        loaded_imgs[i] = [ds.frame(i, e)[roi] for e in ds.exposures]
+        if as_uint8:
+            loaded_imgs[i] = [(img >> 4).astype(np.uint8) for img in loaded_imgs[i]]
+    return (loaded_imgs, ds.exposures)
+
+def load_dataset(dirname, indexes=None, as_uint8=False, roi=None):
     """
-    Make sure no other files are in this data dir.
-    Including processed files generated with this script.
+    only the captures in the data dir are loaded (see frame_paths), but
+    there must be one for every led and exposure.
+
+    roi: optional (y, x) tuple of slices to crop every image to.
     """
-    paths = list(Path(dirname).glob("*"))
+    if dataset.is_dataset(dirname):
+        return load_container(dirname, indexes, as_uint8, roi)
+    if shared_loading:
+        return load_shared(dirname, indexes, as_uint8, roi)
+    paths = frame_paths(dirname)
     led_count, exposures = get_img_info(dirname)
     # matcher = re.compile(".*img(\d*)_(\d*)us.*")
     # matches = [matcher.search(str(path)) for path in paths]
@@ -83,6 +309,8 @@ def load_dataset(dirname, indexes=None, as_uint8=False):
         for p in procs:
             p.join()
         loaded_imgs = dict(loaded_imgs)
+    if roi is not None:
+        loaded_imgs = {i: [img[roi] for img in imgs] for i, imgs in loaded_imgs.items()}
     return (loaded_imgs, exposures)
 
 
@@ -123,7 +351,7 @@ def combine_hdr(images, exposures, response = None):
     #res_devebec = tonemap.process(hdr_devebec.copy())
     return hdr_devebec
 
-def batch_hdr(image_dict, exposures, response=None):
+def batch_hdr(image_dict, exposures, response=None, calibrate_img_idx=None):
     """
     generate response and then run combine_hdr in batch.
 
@@ -131,18 +359,277 @@ def batch_hdr(image_dict, exposures, response=None):
     """
     exposures = np.float32([e / 1000000 for e in exposures])
     if response is None:
+        if calibrate_img_idx is None:
+            calibrate_img_idx = next(iter(image_dict))
         calibration = cv.createCalibrateDebevec()
         response = calibration.process(image_dict[calibrate_img_idx], exposures)
     result = batch_process(combine_hdr, image_dict, exposures, response)
     return result
 
-def demosaic_channel(img, channel=None):
+def bayer_order_of(bayer_array):
+    """
+    colors of the top left 2x2 block of a (height, width, 3) bayer array,
+    read off which channel is used at each position (in a corner of it).
+    """
+    corner = np.asarray(bayer_array[:64, :64])
+    return "".join("RGB"[np.argmax(corner[y::2, x::2].reshape(-1, 3).sum(axis=0))]
+                   for y in (0, 1) for x in (0, 1))
+
+def get_bayer_order(dirname):
+    """
+    the bayer order the captures in dirname were saved with: from the
+    dataset container, a .pb12 header or a tiff's metadata (see
+    run_fpm.py). bayer_pattern if they don't say.
+    """
+    order = None
+    if dataset.is_dataset(dirname):
+        order = dataset.FPMDataset(dirname).meta.get('bayer_order')
+    else:
+        path = next(iter(frame_paths(dirname)), None)
+        if path is not None and path.suffix == '.pb12':
+            with open(path, 'rb') as f:
+                order = packed_bayer.parse_header(f.read(packed_bayer.header_size))['bayer_order']
+        elif path is not None:
+            with tiff.TiffFile(str(path)) as f:
+                order = (f.shaped_metadata or [{}])[0].get('bayer_order')
+    return order or bayer_pattern
+
+def saturation_level(dirname=None):
+    """
+    the first pixel value (at the bit depth images are loaded with) that
+    means saturated: the sensor's full scale minus the dark level that was
+    subtracted, from the dataset container or a .pb12 header if there is one.
+    """
+    dark = dark_level
+    if dirname is not None and dataset.is_dataset(dirname):
+        dark = dataset.FPMDataset(dirname).meta.get('dark_level', dark_level)
+    elif dirname is not None:
+        packed = next(Path(dirname).glob("img*_*us.pb12"), None)
+        if packed is not None:
+            with open(packed, 'rb') as f:
+                dark = packed_bayer.parse_header(f.read(packed_bayer.header_size))['dark_level']
+    saturation = 2 ** sensor_bits - 1 - dark
+    return saturation >> 4 if as_uint8 else saturation
+
+def hdr_weights(levels, saturation=None):
+    """
+    debevec's hat weighting: trust mid-range pixel values the most. Values at
+    or above saturation (default: levels) get no weight at all, they only
+    bound the radiance from below.
+    """
+    top = levels if saturation is None else min(saturation, levels)
+    z = np.arange(levels, dtype=np.float32)
+    w = np.minimum(z, top - 1 - z) + 1e-3 # never exactly 0 below saturation
+    w[top:] = 0
+    return w
+
+def linear_response(levels):
+    """
+    response curve (log exposure of every pixel value) of a linear sensor
+    """
+    return np.log(np.maximum(np.arange(levels), 0.5)).astype(np.float32)
+
+def calibrate_response(images, exposures, levels=4096, bins=256,
+                       samples=None, smoothness=None, saturation=None):
+    """
+    debevec & malik response curve from the (exposure, height, width)
+    images of a single led, solved with numpy least squares. The curve is
+    solved on `bins` bins of pixel values and interpolated to all `levels`.
+    Saturated samples (see hdr_weights) are left out, so nothing constrains
+    the curve there: it is extrapolated from the top of the solved range up
+    to saturation, and flat from there on (those values only say "at least
+    full scale").
+
+    exposures in us. returns g, the log exposure of every pixel value.
+    """
+    samples = response_samples if samples is None else samples
+    smoothness = response_smoothness if smoothness is None else smoothness
+    images = np.asarray(images).reshape(len(exposures), -1)
+    rng = np.random.default_rng(0) # the same pixels every time
+    idx = rng.choice(images.shape[1], min(samples, images.shape[1]), replace=False)
+    samples = len(idx)
+    z = np.minimum(images[:, idx].astype(np.int64) * bins // levels, bins - 1).ravel()
+    top = bins if saturation is None else min(saturation * bins // levels, bins)
+    w = hdr_weights(bins, top)
+    log_t = np.log(np.float64(exposures) / 1000000)
+
+    n = len(z)
+    A = np.zeros((n + bins - 1, bins + samples))
+    b = np.zeros(A.shape[0])
+    rows = np.arange(n)
+    A[rows, z] = w[z]
+    A[rows, bins + np.tile(np.arange(samples), len(exposures))] = -w[z]
+    b[rows] = w[z] * np.repeat(log_t, samples)
+    A[n, bins // 2] = 1 # fix the curve's scale: g(middle) = 0
+    rows = n + 1 + np.arange(bins - 2)
+    cols = np.arange(bins - 2)
+    A[rows, cols] = smoothness * w[1:-1]
+    A[rows, cols + 1] = -2 * smoothness * w[1:-1]
+    A[rows, cols + 2] = smoothness * w[1:-1]
+    g = np.linalg.lstsq(A, b, rcond=None)[0][:bins]
+    step = max(top // 8, 1) # slope of the top eighth of the solved curve
+    slope = max((g[top - 1] - g[top - 1 - step]) / step, 0)
+    g[top:] = g[top - 1] + slope * np.arange(1, bins - top + 1)
+    centers = (np.arange(bins) + 0.5) * levels / bins
+    g = np.interp(np.arange(levels), centers, g)
+    if saturation is not None and saturation < levels:
+        g[saturation:] = g[saturation - 1]
+    return g.astype(np.float32)
+
+def merge_hdr_stack(stack, exposures, response, saturation=None):
+    """
+    merge a whole (led, exposure, height, width) stack of integer images in
+    one vectorized pass (debevec weighting). response is the log exposure of
+    every pixel value (e.g. from calibrate_response), exposures in us,
+    saturation the first saturated pixel value (see saturation_level).
+    Pixels saturated at every exposure are the brightest there are: they get
+    full scale at the shortest exposure (see radiance_to_uint16), a lower
+    bound of their radiance.
+    returns float32 radiance of shape (led, height, width).
+    """
+    stack = np.asarray(stack)
+    levels = len(response)
+    w = hdr_weights(levels, saturation)
+    log_t = np.log(np.float64(exposures) / 1000000).astype(np.float32)
+    num = np.zeros(stack.shape[:1] + stack.shape[2:], dtype=np.float32)
+    den = np.zeros_like(num)
+    for j in range(len(exposures)):
+        z = np.minimum(stack[:, j], levels - 1)
+        wj = w[z]
+        num += wj * (response[z] - log_t[j])
+        den += wj
+    saturated = den == 0
+    num[saturated] = _full_scale_log(exposures, response, saturation)
+    den[saturated] = 1
+    return np.exp(num / den)
+
+def _full_scale_log(exposures, response, saturation=None):
+    """
+    log radiance of the last unsaturated pixel value at the shortest exposure
+    """
+    top = len(response) if saturation is None else min(saturation, len(response))
+    return response[top - 1] - np.log(min(exposures) / 1000000)
+
+def radiance_to_uint16(radiance, exposures, response, saturation=None):
+    """
+    scale so that full scale (the last unsaturated pixel value) at the
+    shortest exposure maps to the uint16 maximum. The scale is the same for
+    every led, so relative intensities (which fpm needs) survive, unlike with
+    a per image tonemap.
+    """
+    full_scale = np.exp(_full_scale_log(exposures, response, saturation))
+    return np.clip(radiance * (65535 / full_scale), 0, 65535).astype(np.uint16)
+
+def response_cache_path(exposures, ag, dg, levels, saturation, channel, engine):
+    key = "{}_{}_ag{}_dg{}_{}levels_sat{}_ch{}_{}us_v2".format( # v2: older curves have no saturated tail
+        engine, sensor, ag, dg, levels, saturation, channel,
+        "-".join(str(e) for e in exposures))
+    return response_cache_dir / (key + ".npy")
+
+def get_response(dirname, exposures, channel, calibrate=True):
+    """
+    the response curve for this sensor, gain and exposure set. Calibrated
+    from calibration_led the first time and then loaded from
+    response_cache_dir. Without calibrate, returns None instead of
+    calibrating.
+    """
+    levels = 256 if as_uint8 else 4096
+    if hdr_engine == 'numpy' and hdr_response == 'linear':
+        return linear_response(levels)
+    meta = dataset.FPMDataset(dirname).meta if dataset.is_dataset(dirname) else {}
+    saturation = saturation_level(dirname)
+    path = response_cache_path(exposures, meta.get('analog_gain', analog_gain),
+                               meta.get('digital_gain', digital_gain), levels, saturation,
+                               channel, hdr_engine)
+    if path.exists():
+        print("using cached response curve {}".format(path))
+        return np.load(path)
+    if not calibrate:
+        return None
+    print("calibrating response curve from led {}...".format(calibration_led))
+    cal_data = {}
+    load_images(dirname, calibration_led, cal_data, as_uint8)
+    if hdr_engine == 'opencv':
+        imgs = cal_data[calibration_led]
+        if imgs[0].ndim == 2: # MergeDebevec wants 3 channel images
+            imgs = [np.repeat(img[..., np.newaxis], 3, axis=-1) for img in imgs]
+        response = cv.createCalibrateDebevec().process(
+            imgs, np.float32([e / 1000000 for e in exposures]))
+    else:
+        planes = demosaic_stack(cal_data[calibration_led], channel,
+                                'native' if demosaic_mode == 'full' else demosaic_mode,
+                                get_bayer_order(dirname))
+        response = calibrate_response(planes, exposures, levels, saturation=saturation)
+    response_cache_dir.mkdir(parents=True, exist_ok=True)
+    np.save(path, response)
+    return response
+
+def demosaic_channel(img, channel=None, pattern=None):
+    """
+    img is either a (height, width, 3) bayer array or a 2d mosaic (.pb12),
+    pattern its bayer order (default bayer_pattern).
+    """
+    pattern = pattern or bayer_pattern
+    if img.ndim == 2:
+        if channel == None:
+            mosaic = img
+        else:  # only keep this channel's pixels, like img[:, :, channel] below
+            mask = colour_demosaicing.masks_CFA_Bayer(img.shape, pattern)[channel]
+            mosaic = img * mask
+        return colour_demosaicing.demosaicing_CFA_Bayer_bilinear(
+            mosaic, pattern).astype(img.dtype)
     if channel == None:  # get color image
         return colour_demosaicing.demosaicing_CFA_Bayer_bilinear(
-            np.sum(img, axis=2), 'BGGR').astype(img.dtype)
+            np.sum(img, axis=2), pattern).astype(img.dtype)
     else:
         return colour_demosaicing.demosaicing_CFA_Bayer_bilinear(
-            img[:, :, channel], 'BGGR').astype(img.dtype)
+            img[:, :, channel], pattern).astype(img.dtype)
+
+def _channel_sites(channel, pattern=None):
+    """
+    (y, x) offsets of the channel's pixels in a 2x2 block of pattern
+    (default bayer_pattern)
+    """
+    return [(i // 2, i % 2) for i, c in enumerate(pattern or bayer_pattern) if c == "RGB"[channel]]
+
+def demosaic_stack(stack, channel, mode='native', pattern=None):
+    """
+    only the `channel` plane of a whole stack of (n, height, width) mosaics
+    (or (n, height, width, 3) bayer arrays) with bayer order pattern
+    (default bayer_pattern), in one vectorized pass.
+
+    mode 'native': just the channel's own pixels, (n, height/2, width/2).
+        green has two pixels per block, those are averaged.
+    mode 'bilinear': full resolution, the same result as
+        demosaic_channel(img, channel)[:, :, channel] for every image.
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 4: # only one channel is nonzero per pixel
+        stack = stack.sum(axis=-1, dtype=stack.dtype)
+    sites = _channel_sites(channel, pattern)
+    if mode == 'native':
+        planes = [stack[:, y::2, x::2] for y, x in sites]
+        if len(planes) == 1:
+            return np.ascontiguousarray(planes[0])
+        return ((planes[0].astype(np.uint32) + planes[1]) // 2).astype(stack.dtype)
+    # bilinear: same kernels as colour_demosaicing, only for this channel.
+    # the weights are multiples of 1/4, so float32 is exact for 12 bit data.
+    if len(sites) == 2:
+        kernel = [[0, .25, 0], [.25, 1, .25], [0, .25, 0]]
+    else:
+        kernel = [[.25, .5, .25], [.5, 1, .5], [.25, .5, .25]]
+    masked = np.zeros(stack.shape, dtype=np.float32)
+    for y, x in sites:
+        masked[:, y::2, x::2] = stack[:, y::2, x::2]
+    padded = np.pad(masked, ((0, 0), (1, 1), (1, 1)), mode='symmetric')
+    del masked
+    height, width = stack.shape[1:]
+    out = np.zeros((stack.shape[0], height, width), dtype=np.float32)
+    for dy in range(3):
+        for dx in range(3):
+            if kernel[dy][dx]:
+                out += kernel[dy][dx] * padded[:, dy:dy + height, dx:dx + width]
+    return out.astype(stack.dtype)
 
 def hdr_uint_convert(img, dtype, max_val):
     """
@@ -153,56 +640,350 @@ def hdr_uint_convert(img, dtype, max_val):
     out = tonemap.process(img)
     return (out*uint_max).astype(dtype)
     
+class MemoryBudget:
+    """
+    acquire() blocks while handing out more bytes would exceed the budget.
+    Something bigger than the whole budget is let through once nothing else
+    is out, so it can't deadlock.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.cond:
+            self.cond.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.budget)
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+_pool = None
+_budget = None
+
+def get_pool():
+    """
+    the worker pool and memory budget shared by every batch_process call,
+    started on first use.
+    """
+    global _pool, _budget
+    if _pool is None:
+        _pool = multiprocessing.Pool(process_workers)
+        _budget = MemoryBudget(memory_budget)
+    return _pool, _budget
+
+def _nbytes(img):
+    if isinstance(img, (list, tuple)):
+        return sum(_nbytes(i) for i in img)
+    return np.asarray(img).nbytes
+
+class _FileView:
+    """
+    where an array that's a view into a file backed np.memmap (the dataset
+    container, load_shared's block) is, so a worker can map it again
+    instead of having its pixels pickled over.
+    """
+    def __init__(self, img):
+        root = img
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        address = img.__array_interface__['data'][0]
+        low = address + sum(min(0, (n - 1) * s) for n, s in zip(img.shape, img.strides))
+        high = address + sum(max(0, (n - 1) * s) for n, s in zip(img.shape, img.strides))
+        self.filename = root.filename
+        self.offset = root.offset + low - root.__array_interface__['data'][0]
+        self.nbytes = high - low + img.itemsize
+        self.start = address - low
+        self.dtype, self.shape, self.strides = img.dtype, img.shape, img.strides
+
+    @staticmethod
+    def shareable(img):
+        if not isinstance(img, np.memmap) or img.size == 0:
+            return False
+        root = img
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        return isinstance(root, np.memmap) and root.filename is not None
+
+    def open(self):
+        buf = np.memmap(self.filename, dtype=np.uint8, mode='r', offset=self.offset,
+                        shape=(self.nbytes,))
+        return np.ndarray(self.shape, self.dtype, buffer=buf, offset=self.start,
+                          strides=self.strides)
+
+def _to_worker(img):
+    if isinstance(img, (list, tuple)):
+        return [_to_worker(i) for i in img]
+    return _FileView(img) if _FileView.shareable(img) else img
+
+def _from_parent(img):
+    if isinstance(img, list):
+        return [_from_parent(i) for i in img]
+    return img.open() if isinstance(img, _FileView) else img
+
+def _call(func, img, args):
+    return func(_from_parent(img), *args)
+
 def batch_process(func, imgs, *args):
-    with multiprocessing.Manager() as manager:
-        procs = []
-        processed_imgs = manager.dict()
-        if type(imgs) == dict:
-            iterator = imgs.items()
+    """
+    run func(img, *args) for every image (or list of images) on the worker
+    pool. Images that are views into a memory-mapped file are mapped again
+    by the worker, not pickled. A task is only started once its memory
+    (estimated as twice its input, for input and result) fits in
+    memory_budget.
+    """
+    pool, budget = get_pool()
+    if type(imgs) == dict:
+        iterator = imgs.items()
+    else:
+        iterator = enumerate(imgs)
+    pending = []
+    for i, img in iterator:
+        cost = 2 * _nbytes(img)
+        budget.acquire(cost)
+        release = lambda _, cost=cost: budget.release(cost)
+        pending.append((i, pool.apply_async(_call, (func, _to_worker(img), args),
+                                            callback=release, error_callback=release)))
+    return {i: result.get() for i, result in pending}
+
+def process_chunk(data, exposures, response, channel, saturation=None, pattern=None):
+    """
+    demosaic and hdr merge (or pick an exposure for) every led in data.
+    saturation: see merge_hdr_stack, pattern: the bayer order (see
+    get_bayer_order).
+    returns a dict of single channel images by led.
+    """
+    data = dict(data)
+    leds = sorted(data)
+    with tracing.span('demosaic', leds=leds):
+        if demosaic_mode == 'full':
+            for pxl, imgs in data.items():
+                data[pxl] = list(batch_process(demosaic_channel, imgs, channel,
+                                               pattern).values())
+        else: # one vectorized demosaic_stack call per led, over all its exposures
+            data = batch_process(demosaic_stack, data, channel, demosaic_mode, pattern)
+            if run_hdr and hdr_engine == 'opencv': # MergeDebevec wants 3 channel images
+                data = {pxl: np.repeat(planes[..., np.newaxis], 3, axis=-1)
+                        for pxl, planes in data.items()}
+    with tracing.span('hdr' if run_hdr else 'select', leds=leds):
+        if run_hdr and hdr_engine == 'numpy':
+            pxls = list(data.keys())
+            stack = np.stack([np.asarray(data[pxl]) for pxl in pxls])
+            if stack.ndim == 5: # demosaic_mode 'full'
+                stack = stack[..., channel]
+            radiance = merge_hdr_stack(stack, exposures, response, saturation)
+            images = dict(zip(pxls, radiance_to_uint16(radiance, exposures, response,
+                                                       saturation)))
+        elif run_hdr:
+            images = batch_hdr(data, exposures, response)
+            images = batch_process(hdr_uint_convert, images, np.uint16, np.max(list(images.values())))
         else:
-            iterator = enumerate(imgs)
-        for i, img in iterator:
-            while (psutil.virtual_memory().available < 8000000000): # todo make this configurable maybe.
-                print("waiting for mem to clear up...")
-                time.sleep(1)
-            p = multiprocessing.Process(target=_batch_wrapper,
-                                        args=(func, i, img, processed_imgs,
-                                              *args))
-            p.start()
-            procs.append(p)
-        for p in procs:
-            p.join()
-        processed_imgs = dict(processed_imgs)
-    return processed_imgs
+            images = {}
+            for key in data.keys():
+                images[key] = data[key][exposure_chosen_idx]
+    return {pxl: img[:,:,channel] if img.ndim == 3 else img for pxl, img in images.items()}
 
-def _batch_wrapper(func, i, img, out_dict, *args):
-    out_dict[i] = func(img, *args)
+def process_led(imgs, exposures, response, channel, run_exposures=None, saturation=None,
+                pattern=None):
+    """
+    what process_chunk does, for the exposures of a single led (used to
+    process leds while the run is still being captured, see server/run_fpm.py).
+    Always uses demosaic_stack and the numpy hdr engine; 'full' demosaicing
+    gives the same channel as 'bilinear'.
 
-def process_dataset(data, exposures, response, channel):
-    for pxl, imgs in data.items():
-        data[pxl] = list(batch_process(demosaic_channel, imgs, channel).values())
+    every led comes out the same way, whatever it was captured at: hdr
+    radiance scaled by radiance_to_uint16 (for the run's exposures), or
+    otherwise counts at run_exposures[exposure_chosen_idx], in the dtype of
+    the loaded images (uint16, uint8 with as_uint8). If the led was only
+    captured at some of the run's exposures (run_exposures, see
+    adaptive_exposure in rpi/run_fpm.py), the longest one there is gets
+    scaled to that exposure, clipped to the dtype's range.
+    """
+    run_exposures = exposures if run_exposures is None else sorted(run_exposures)
+    mode = 'bilinear' if demosaic_mode == 'full' else demosaic_mode
+    planes = demosaic_stack(np.asarray(imgs), channel, mode, pattern)
     if run_hdr:
-        images = batch_hdr(data, exposures, response)
-        images = batch_process(hdr_uint_convert, images, np.uint16, np.max(list(images.values())))
-    else:
-        images = {}
-        for key in data.keys():
-            images[key] = data[key][exposure_chosen_idx]
-    for pxl, img in images.items():
+        radiance = merge_hdr_stack(planes[np.newaxis], exposures, response, saturation)
+        return radiance_to_uint16(radiance, run_exposures, response, saturation)[0]
+    if list(exposures) == list(run_exposures):
+        return planes[exposure_chosen_idx]
+    # the capture already dropped saturated exposures
+    reference = run_exposures[exposure_chosen_idx]
+    scaled = np.round(planes[-1] * (reference / exposures[-1]))
+    return np.clip(scaled, 0, np.iinfo(planes.dtype).max).astype(planes.dtype)
+
+@functools.lru_cache(maxsize=None)
+def _have_imagecodecs():
+    try:
+        import imagecodecs
+    except ImportError:
+        return False
+    return True
+
+@functools.lru_cache(maxsize=None)
+def _compression(compression):
+    if compression == 'zstd' and not _have_imagecodecs():
+        print("WARNING: zstd needs imagecodecs, using zlib")
+        return 'zlib'
+    return compression
+
+def tiff_options(img):
+    """
+    tifffile write keywords for img, from the tiff_* settings.
+    """
+    options = {'tile': tiff_tile, 'maxworkers': tiff_workers}
+    compression = _compression(tiff_compression)
+    if compression:
+        options['compression'] = compression
+        if tiff_predictor and (np.dtype(img.dtype).kind in 'ui' or _have_imagecodecs()):
+            options['predictor'] = True
+    return options
+
+def write_image(pxl, img, stack=None):
+    """
+    write a processed image to img{pxl}.tiff, or as a page of stack (an open
+    TiffWriter, see output_stack) whose description is {"led": pxl}.
+    """
+    with tracing.span('write', led=pxl, bytes=img.nbytes):
+        if stack is not None:
+            stack.write(img, description=json.dumps({'led': pxl}), metadata=None,
+                        **tiff_options(img))
+            return
         print("writing {}".format(str(dest_dir / Path("img{}.tiff".format(pxl)))))
-        tiff.imwrite(str(dest_dir / Path("img{}.tiff".format(pxl))), img[:,:,channel])
-        
+        tiff.imwrite(str(dest_dir / Path("img{}.tiff".format(pxl))), img, **tiff_options(img))
+
+def _process_adaptive_led(dirname, pxl, exposures, run_exposures, response, channel):
+    imgs = {}
+    with tracing.span('load', led=pxl):
+        load_images(dirname, pxl, imgs, as_uint8)
+    with tracing.span('process', led=pxl):
+        img = process_led(imgs[pxl], exposures, response, channel, run_exposures,
+                          saturation_level(dirname), get_bayer_order(dirname))
+    write_image(pxl, img)
+
+def run_adaptive(dirname, led_exposures, run_exposures, response, channel):
+    """
+    process a capture whose leds have different exposures (see
+    adaptive_exposure in rpi/run_fpm.py). They can't be stacked into chunks,
+    so every led is loaded and processed on its own, on the worker pool.
+    """
+    pool, _ = get_pool()
+    pool.starmap(_process_adaptive_led,
+                 [(dirname, pxl, exposures, run_exposures, response, channel)
+                  for pxl, exposures in sorted(led_exposures.items())])
+
+def process_dataset(data, exposures, response, channel, saturation=None, pattern=None):
+    for pxl, img in process_chunk(data, exposures, response, channel, saturation,
+                                  pattern).items():
+        write_image(pxl, img)
+
+def report_queue_depths(loaded, writes):
+    pool, budget = get_pool()
+    print("queues: {} chunk(s) loaded ahead, {} image(s) waiting to be written, "
+          "{:.2f} of {:.2f} GB in flight on the workers".format(
+              loaded.qsize(), writes.qsize(), budget.used / 1e9, budget.budget / 1e9))
+
+def run_pipeline(dirname, led_count, response, channel):
+    """
+    load -> demosaic/hdr -> write every chunk of chunksize leds. The next
+    chunk(s) load in the background while the current one is processed, and
+    finished images are written by write_workers threads, so the cpu and the
+    disk both stay busy.
+    """
+    loaded = queue.Queue(maxsize=prefetch_chunks)
+    writes = queue.Queue(maxsize=max_pending_writes)
+    saturation = saturation_level(dirname)
+    pattern = get_bayer_order(dirname)
+    stack = None
+    if output_stack:
+        print("writing {}".format(dest_dir / stack_name))
+        stack = tiff.TiffWriter(str(dest_dir / stack_name), bigtiff=True)
+    stack_lock = threading.Lock() # pages are written one at a time (tiles in parallel)
+    stop = threading.Event()
+    write_errors = []
+
+    def loader():
+        try:
+            for chunk_start in range(0, led_count, chunksize):
+                if stop.is_set():
+                    return
+                chunk_end = min(chunk_start + chunksize, led_count)
+                with tracing.span('load', leds=list(range(chunk_start, chunk_end))):
+                    chunk = load_dataset(dirname, range(chunk_start, chunk_end), as_uint8)
+                loaded.put((chunk_start, chunk_end, chunk))
+        except Exception as e: # raised again by the main loop
+            loaded.put(e)
+            return
+        loaded.put(None)
+
+    def writer():
+        while True:
+            item = writes.get()
+            if item is None:
+                return
+            if write_errors: # only drain, so the main loop doesn't block
+                continue
+            try:
+                if stack is None:
+                    write_image(*item)
+                else:
+                    with stack_lock:
+                        write_image(*item, stack=stack)
+            except Exception as e:
+                write_errors.append(e)
+
+    threads = [threading.Thread(target=loader)]
+    threads += [threading.Thread(target=writer) for _ in range(write_workers)]
+    for t in threads:
+        t.start()
+    try:
+        while not write_errors:
+            item = loaded.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            chunk_start, chunk_end, (data, exposures) = item
+            print("starting imgs {} -> {}".format(chunk_start, chunk_end - 1))
+            for pxl, img in process_chunk(data, exposures, response, channel,
+                                          saturation, pattern).items():
+                writes.put((pxl, img))
+            report_queue_depths(loaded, writes)
+    finally:
+        # also when something failed: stop the loader (it may be blocked on a
+        # full queue) and let the writers finish, or they'd keep the
+        # process alive
+        stop.set()
+        while threads[0].is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for _ in range(write_workers):
+            writes.put(None)
+        for t in threads:
+            t.join()
+        if stack is not None:
+            stack.close()
+    if write_errors:
+        raise write_errors[0]
 
 if __name__ == '__main__':
+    if trace_path is not None:
+        tracing.enable(trace_path)
     led_count, exposures = get_img_info(local_data_dir)
-    
-    cal_data = {}
-    exp = np.float32([e / 1000000 for e in exposures])
-    load_images(local_data_dir, 43, cal_data, as_uint8)
-    response = cv.createCalibrateDebevec().process(cal_data[43], exp)
-
-    for chunk_start in range(0, led_count, chunksize):
-        chunk_end = min(chunk_start + chunksize, led_count)
-        print("starting imgs {} -> {}".format(chunk_start, chunk_end - 1))
-        data, exposures = load_dataset(local_data_dir, range(chunk_start, chunk_end), as_uint8)
-        process_dataset(data, exposures, response, 0) # 0 = red channel
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    write_capture_info(local_data_dir)
+    led_exposures = get_led_exposures(local_data_dir)
+    if led_exposures is None:
+        response = get_response(local_data_dir, exposures, 0) if run_hdr else None
+        run_pipeline(local_data_dir, led_count, response, 0) # 0 = red channel
+    else:
+        run_exposures = get_run_info(local_data_dir).get('exposure_times', exposures)
+        response = None
+        if run_hdr: # calibrated from whatever calibration_led was captured at
+            response = get_response(local_data_dir, led_exposures[calibration_led], 0)
+        run_adaptive(local_data_dir, led_exposures, run_exposures, response, 0)
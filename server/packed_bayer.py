@@ -0,0 +1,104 @@
+"""
+Read and write the packed 12-bit bayer format the pi saves its captures in
+(see `raw_format` in rpi/run_fpm.py).
+
+PiBayerArray.array is (height, width, 3) uint16 with only one nonzero channel
+per pixel, and the sensor only has 12 bits. A .pb12 file instead stores the 2d
+mosaic at 12 bits per pixel (two pixels in three bytes), about 4x smaller:
+
+    header (little endian, header_format):
+        magic       4s  b'PB12'
+        version     B   1
+        bayer order 4s  e.g. b'BGGR' (colors of the top left 2x2 block, row major)
+        height      I
+        width       I
+        exposure    I   us
+        analog gain f
+        digital gain f
+        dark level  H   already subtracted from the data (0 = raw sensor values)
+    data:
+        pixel pairs (p0, p1) as bytes: p0 & 0xff, (p0 >> 8) | (p1 & 0xf) << 4, p1 >> 4
+"""
+import struct
+
+import numpy as np
+
+magic = b'PB12'
+version = 1
+header_format = '<4sB4sIIIffH'
+header_size = struct.calcsize(header_format)
+
+
+def pack12(mosaic):
+    """
+    pack a 2d uint16 mosaic (values < 4096, even pixel count) into bytes.
+    """
+    pairs = np.ascontiguousarray(mosaic, dtype=np.uint16).reshape(-1, 2)
+    packed = np.empty((pairs.shape[0], 3), dtype=np.uint8)
+    packed[:, 0] = pairs[:, 0] & 0xff
+    packed[:, 1] = (pairs[:, 0] >> 8) | ((pairs[:, 1] & 0xf) << 4)
+    packed[:, 2] = pairs[:, 1] >> 4
+    return packed
+
+
+def unpack12(packed, height, width):
+    """
+    inverse of pack12: bytes (or a uint8 array/memmap) to a (height, width)
+    uint16 mosaic.
+    """
+    packed = np.frombuffer(packed, dtype=np.uint8, count=height * width * 3 // 2)
+    packed = packed.reshape(-1, 3).astype(np.uint16)
+    mosaic = np.empty((packed.shape[0], 2), dtype=np.uint16)
+    mosaic[:, 0] = packed[:, 0] | ((packed[:, 1] & 0xf) << 8)
+    mosaic[:, 1] = (packed[:, 1] >> 4) | (packed[:, 2] << 4)
+    return mosaic.reshape(height, width)
+
+
+def parse_header(buf):
+    (file_magic, file_version, order, height, width, exposure,
+     analog_gain, digital_gain, dark_level) = struct.unpack_from(header_format, buf)
+    if file_magic != magic or file_version != version:
+        raise ValueError("not a version {} packed bayer file".format(version))
+    return {
+        'bayer_order': order.decode(),
+        'height': height,
+        'width': width,
+        'exposure': exposure,
+        'analog_gain': analog_gain,
+        'digital_gain': digital_gain,
+        'dark_level': dark_level,
+    }
+
+
+def read_packed(path):
+    """
+    returns (header dict, (height, width) uint16 mosaic). The packed data is
+    memory-mapped, so only the unpacked mosaic is held in memory.
+    """
+    with open(path, 'rb') as f:
+        header = parse_header(f.read(header_size))
+    packed = np.memmap(path, dtype=np.uint8, mode='r', offset=header_size)
+    return header, unpack12(packed, header['height'], header['width'])
+
+
+def loads_packed(buf):
+    """
+    like read_packed, for a file that's already in memory.
+    """
+    header = parse_header(buf)
+    return header, unpack12(memoryview(buf)[header_size:],
+                            header['height'], header['width'])
+
+
+def write_packed(path, mosaic, header):
+    """
+    header needs the same keys read_packed returns (height/width are taken
+    from the mosaic).
+    """
+    height, width = mosaic.shape
+    with open(path, 'wb') as f:
+        f.write(struct.pack(header_format, magic, version,
+                            header['bayer_order'].encode(), height, width,
+                            header['exposure'], header['analog_gain'],
+                            header['digital_gain'], header['dark_level']))
+        f.write(pack12(mosaic).tobytes())
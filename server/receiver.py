@@ -0,0 +1,111 @@
+"""
+Small http endpoint the pi pushes its captures to (see upload_url in
+rpi/run_fpm.py), so it never has to hold more than a few frames.
+
+The pi PUTs every frame to /<file name> with its crc32 in an X-CRC32 header.
+The body is streamed to a temporary file in the receiving directory, with the
+crc computed on the way. On a match it's moved to <file name>.part, the reply
+is "<size> <crc32>" with status 200, and the pi may delete its copy. On a
+mismatch the file is dropped and the reply is 422, so the pi sends it again.
+A file that was already received is acked without touching the disk.
+"""
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import tempfile
+import threading
+import zlib
+
+chunk_size = 1 << 20
+
+
+class _PushHandler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        server = self.server
+        name = Path(unquote(urlparse(self.path).path)).name
+        try:
+            size = int(self.headers['Content-Length'])
+            expected_crc = int(self.headers['X-CRC32'], 16)
+        except (TypeError, ValueError):
+            self.send_error(400, "need Content-Length and X-CRC32")
+            return
+        with server.lock:
+            record = server.received.get(name)
+        if record is not None:
+            # the pi resends if an ack gets lost. never touch our copy, a
+            # worker may be reading it
+            self._discard(size)
+            self._ack(*record)
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=server.dirname)
+        try:
+            crc = 0
+            remaining = size
+            with os.fdopen(fd, 'wb') as f:
+                while remaining:
+                    chunk = self.rfile.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining: # the pi hung up, nobody to answer
+                return
+            if crc != expected_crc:
+                self.send_error(422, "checksum mismatch")
+                return
+            with server.lock:
+                new = name not in server.received # another upload of it may have won
+                if new:
+                    os.replace(tmp_path, server.dirname / (name + '.part'))
+                    server.received[name] = (size, crc)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self._ack(size, crc)
+        if new:
+            server.on_file(name)
+
+    def _discard(self, size):
+        while size:
+            chunk = self.rfile.read(min(chunk_size, size))
+            if not chunk:
+                return
+            size -= len(chunk)
+
+    def _ack(self, size, crc):
+        body = "{} {:08x}\n".format(size, crc).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # one line per frame is too much noise
+
+
+class PushReceiver(ThreadingHTTPServer):
+    """
+    receives pushed captures into dirname, calling on_file(name) (from the
+    request's thread, after the pi got its ack) once for every verified file,
+    which is then at dirname/<name>.part.
+    """
+    daemon_threads = False # so stop() waits for uploads in progress
+
+    def __init__(self, port, dirname, on_file):
+        super().__init__(('', port), _PushHandler)
+        self.dirname = Path(dirname)
+        self.on_file = on_file
+        self.received = {} # name: (size, crc32)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,465 @@
+"""
+Fourier ptychographic reconstruction of the images image_cleanup.py writes
+(img{pxl}.tiff in its dest_dir, or the pages of its stack_name BigTIFF).
+
+Recovers the high resolution complex object together with the pupil
+function (in the style of EPRY, Ou et al. 2014). Instead of updating the
+spectrum one led at a time, every iteration runs the forward model for all
+leds at once (one batched fft over the whole (led, y, x) stack) and applies
+the combined, overlap-normalized update to the spectrum and the pupil.
+
+With `tiled` on, the field of view is split into overlapping tiles, each
+reconstructed with the led angles seen from its own position in the field.
+Tiles run in parallel on a process pool, each worker only reading its tile
+out of the tiffs (memory-mapped, or just the tiff tiles it overlaps). They
+are feathered back together into memory-mapped outputs, so memory scales
+with tile_size rather than the sensor.
+
+Multiplexed captures (several leds per image, see multiplex in
+rpi/run_fpm.py) are demultiplexed here: image_cleanup leaves the leds of
+every image in capture_info.json, and the forward model sums the
+intensities of the leds sharing an image (Tian et al. 2014).
+
+Writes the recovered amplitude and phase (float32 tiffs) and the pupil(s) to
+output_dir.
+"""
+from pathlib import Path
+import multiprocessing
+import os
+import json
+
+import numpy as np
+import tifffile as tiff
+
+# ================================= CONFIG ====================================
+input_dir = Path("~/Documents/brake_2020_summer/data/in_progress").expanduser()
+stack_name = "images.tiff" # see output_stack in image_cleanup.py
+output_dir = Path("~/Documents/brake_2020_summer/data/reconstructed").expanduser()
+
+# led matrix geometry (8x8, index = y * ncols + x like the matrix firmware)
+led_ncols = 8
+led_count = 64
+led_pitch = 8.0e-3     # m between neighbouring leds
+led_distance = 60e-3   # m from the matrix to the sample
+led_center = (3.5, 3.5) # (x, y) in led index units that sits on the optical axis
+leds = None            # which images to use (led index, or pattern index if multiplexed), None = all
+
+# optics
+wavelength = 630e-9    # m (red leds, channel 0)
+NA = 0.1               # objective numerical aperture
+magnification = 4
+pixel_size = 2 * 1.55e-6 # m, of the cleaned images on the sensor (IMX477 is 1.55um,
+                         # image_cleanup's 'native' demosaic_mode doubles it)
+
+# reconstruction
+roi = None             # (y0, y1, x0, x1) of the images to reconstruct, None = the full frame
+                       # when tiled, otherwise a centered roi_size square
+roi_size = 256
+upsample = None        # high res / low res size, None = just enough for the outermost led
+iterations = 20
+object_step = 1.0      # alpha: step size of the spectrum update
+pupil_step = 1.0       # beta: step size of the pupil update (0 = keep the initial pupil)
+
+# tiling
+tiled = True           # reconstruct roi (None = the full frame) in overlapping tiles
+tile_size = 256        # low res pixels
+tile_overlap = 32      # low res pixels shared by neighbouring tiles, feathered across
+tile_workers = os.cpu_count()
+# =============================================================================
+
+
+def led_positions(indexes):
+    """
+    (x, y) of every led, in led index units.
+    """
+    indexes = np.asarray(indexes)
+    return np.stack([indexes % led_ncols, indexes // led_ncols], axis=1).astype(np.float64)
+
+
+def led_spatial_frequencies(indexes, position=(0, 0)):
+    """
+    (ky, kx) in 1/m of the plane wave each led illuminates the sample with,
+    seen from position (x, y) in m on the sample (relative to the optical axis).
+    """
+    xy = (led_positions(indexes) - led_center) * led_pitch - position
+    r = np.sqrt(xy[:, 0] ** 2 + xy[:, 1] ** 2 + led_distance ** 2)
+    return np.stack([xy[:, 1] / r, xy[:, 0] / r], axis=1) / wavelength
+
+
+def spectrum_offsets(k, size, dx):
+    """
+    integer shift (in pixels of the low res spectrum) of every led's
+    illumination, for size x size images with (object space) pixel size dx.
+    """
+    return np.round(k * size * dx).astype(int)
+
+
+def pupil_radius(size, dx):
+    return NA / wavelength * size * dx
+
+
+def circular_pupil(size, radius):
+    y, x = np.indices((size, size)) - size // 2
+    return (x ** 2 + y ** 2 <= radius ** 2).astype(np.complex64)
+
+
+def needed_upsample(offsets, size):
+    """
+    smallest integer upsampling that fits every led's window in the high
+    res spectrum.
+    """
+    return int(np.ceil((size + 2 * np.abs(offsets).max()) / size))
+
+
+def _window_index(offsets, size, big_size):
+    """
+    (rows, cols) index arrays picking every led's (size, size) window out of
+    the (big_size, big_size) spectrum, shape (led, size, 1) and (led, 1, size).
+    """
+    start = big_size // 2 - size // 2 + offsets
+    ramp = np.arange(size)
+    return ((start[:, 0, None] + ramp)[:, :, None],
+            (start[:, 1, None] + ramp)[:, None, :])
+
+
+def _fft(field):
+    return np.fft.fftshift(np.fft.fft2(field, axes=(-2, -1)), axes=(-2, -1))
+
+
+def _ifft(spectrum):
+    return np.fft.ifft2(np.fft.ifftshift(spectrum, axes=(-2, -1)), axes=(-2, -1))
+
+
+def forward(spectrum, pupil, offsets, size, image_index=None):
+    """
+    low res intensity images (led, size, size) of a high res spectrum. With
+    image_index (the image each led is lit in), the intensities of leds lit
+    together are summed into (image, size, size).
+    """
+    index = _window_index(offsets, size, spectrum.shape[0])
+    scale = (size / spectrum.shape[0]) ** 2
+    intensities = np.abs(_ifft(spectrum[index] * pupil) * scale) ** 2
+    if image_index is None:
+        return intensities
+    images = np.zeros((image_index.max() + 1, size, size), dtype=intensities.dtype)
+    np.add.at(images, image_index, intensities)
+    return images
+
+
+def reconstruct(images, offsets, pupil, upsample, iterations, object_step=1.0,
+                pupil_step=1.0, support=None, callback=None, image_index=None):
+    """
+    images: (led, size, size) intensities, offsets: (led, 2) from
+    spectrum_offsets, pupil: initial (size, size) pupil (also its support
+    unless support is given). For multiplexed images, images is
+    (image, size, size) and image_index gives the image each led is lit in.
+
+    returns the high res object (size * upsample square, complex) and the
+    recovered pupil. callback(iteration, spectrum, pupil) is called after
+    every iteration.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    count, size = images.shape[:2]
+    big_size = size * upsample
+    amplitudes = np.sqrt(np.maximum(images, 0))
+    support = np.abs(pupil) > 0 if support is None else support
+    pupil = pupil.astype(np.complex64)
+    index = _window_index(offsets, size, big_size)
+    scale = (size / big_size) ** 2
+
+    # start from the upsampled amplitude of the led closest to the axis
+    center_led = np.argmin(np.abs(offsets).sum(axis=1))
+    center_image = center_led if image_index is None else image_index[center_led]
+    start = np.kron(amplitudes[center_image], np.ones((upsample, upsample), dtype=np.float32))
+    spectrum = _fft(start.astype(np.complex64))
+
+    for iteration in range(iterations):
+        windows = spectrum[index]                       # (led, size, size)
+        exit_waves = windows * pupil
+        fields = _ifft(exit_waves) * scale
+        if image_index is None:
+            fields = amplitudes * np.exp(1j * np.angle(fields))
+        else:
+            # leds lit together share their image's measured intensity
+            intensity = np.zeros(amplitudes.shape, dtype=np.float32)
+            np.add.at(intensity, image_index, np.abs(fields) ** 2)
+            ratio = amplitudes / np.sqrt(np.maximum(intensity, np.finfo(np.float32).tiny))
+            fields *= ratio[image_index]
+        diff = _fft(fields) / scale - exit_waves
+
+        # every led's update, normalized by how much pupil overlaps each pixel
+        numerator = np.zeros_like(spectrum)
+        weight = np.zeros(spectrum.shape, dtype=np.float32)
+        np.add.at(numerator, index, np.conj(pupil) * diff)
+        np.add.at(weight, index, np.broadcast_to(np.abs(pupil) ** 2, diff.shape))
+        spectrum += object_step * numerator / (weight + 1e-3 * weight.max())
+
+        if pupil_step:
+            numerator = (np.conj(windows) * diff).sum(axis=0)
+            weight = (np.abs(windows) ** 2).sum(axis=0)
+            pupil += pupil_step * numerator / (weight + 1e-3 * weight.max())
+            pupil *= support
+        if callback is not None:
+            callback(iteration, spectrum, pupil)
+    return _ifft(spectrum), pupil
+
+
+def read_region(page, box):
+    """
+    box ([y0, y1, x0, x1]) of a tiff page, reading as little as possible:
+    uncompressed pages are memory-mapped, tiled pages only have the tiles
+    overlapping box decoded, anything else is read whole.
+    """
+    y0, y1, x0, x1 = box
+    parent = page.parent
+    if page.is_memmappable:
+        img = np.memmap(parent.filehandle.path, mode='r', offset=page.dataoffsets[0],
+                        dtype=np.dtype(page.dtype).newbyteorder(parent.byteorder),
+                        shape=page.shape)
+        return img[y0:y1, x0:x1]
+    if not page.is_tiled:
+        return page.asarray()[y0:y1, x0:x1]
+    height, width = page.tilelength, page.tilewidth
+    across = -(-page.imagewidth // width)
+    out = np.empty((y1 - y0, x1 - x0), dtype=page.dtype)
+    fh = parent.filehandle
+    for ty in range(y0 // height, (y1 - 1) // height + 1):
+        for tx in range(x0 // width, (x1 - 1) // width + 1):
+            index = ty * across + tx
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+            tile = page.decode(data, index, jpegtables=page.jpegtables)[0][0, :, :, 0]
+            ty0, tx0 = ty * height, tx * width
+            sy0, sy1 = max(y0, ty0), min(y1, ty0 + height)
+            sx0, sx1 = max(x0, tx0), min(x1, tx0 + width)
+            out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = \
+                tile[sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+    return out
+
+
+def stack_pages(dirname):
+    """
+    {image index: page} of the stack image_cleanup wrote (see output_stack),
+    None if it wrote a file per image.
+    """
+    path = Path(dirname) / stack_name
+    if not path.exists():
+        return None
+    with tiff.TiffFile(str(path)) as f:
+        return {json.loads(page.description)['led']: i for i, page in enumerate(f.pages)}
+
+
+def open_image(dirname, pxl, pages=None):
+    """
+    (open TiffFile, page) of an image, pages from stack_pages().
+    """
+    if pages is None:
+        f = tiff.TiffFile(str(Path(dirname) / "img{}.tiff".format(pxl)))
+        return f, f.pages[0]
+    f = tiff.TiffFile(str(Path(dirname) / stack_name))
+    return f, f.pages[pages[pxl]]
+
+
+def load_images(dirname, indexes, roi):
+    """
+    (led, y, x) float32 stack of the roi of every led's image, only reading
+    the roi where the tiff allows it (see read_region).
+    """
+    y0, y1, x0, x1 = roi
+    stack = np.empty((len(indexes), y1 - y0, x1 - x0), dtype=np.float32)
+    pages = stack_pages(dirname)
+    for i, pxl in enumerate(indexes):
+        f, page = open_image(dirname, pxl, pages)
+        with f:
+            stack[i] = read_region(page, roi)
+    return stack
+
+
+def capture_info(dirname):
+    """
+    what image_cleanup knows about the capture (see write_capture_info), {}
+    if it didn't leave anything.
+    """
+    path = Path(dirname) / "capture_info.json"
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def optical_axis(dirname, shape):
+    """
+    (y, x) in image pixels of the optical axis: the sensor center, which is
+    off the image center if the pi cropped the frames.
+    """
+    return capture_info(dirname).get('optical_axis') or (shape[0] / 2, shape[1] / 2)
+
+
+def illumination(dirname):
+    """
+    the images to use and the leds lit in them: returns (image indexes, leds,
+    image_index) where image_index[i] is the position in image indexes of
+    the image leds[i] is lit in (None if there's one led per image).
+    """
+    patterns = capture_info(dirname).get('patterns') or [[i] for i in range(led_count)]
+    indexes = list(range(len(patterns))) if leds is None else list(leds)
+    lit = [led for i in indexes for led in patterns[i]]
+    if len(lit) == len(indexes):
+        return indexes, lit, None
+    image_index = np.repeat(np.arange(len(indexes)), [len(patterns[i]) for i in indexes])
+    return indexes, lit, image_index
+
+
+def centered_roi(shape, size):
+    y0 = (shape[0] - size) // 2
+    x0 = (shape[1] - size) // 2
+    return (y0, y0 + size, x0, x0 + size)
+
+
+def field_position(box, axis, dx):
+    """
+    (x, y) in m on the sample of the center of box, relative to the optical
+    axis at (y, x) image pixels.
+    """
+    y0, y1, x0, x1 = box
+    return np.array([(x0 + x1) / 2 - axis[1], (y0 + y1) / 2 - axis[0]]) * dx
+
+
+def box_offsets(indexes, box, axis):
+    dx = pixel_size / magnification
+    k = led_spatial_frequencies(indexes, field_position(box, axis, dx))
+    return spectrum_offsets(k, box[1] - box[0], dx)
+
+
+def image_shape(dirname, indexes):
+    f, page = open_image(dirname, indexes[0], stack_pages(dirname))
+    with f:
+        return page.shape
+
+
+def run(dirname, out_dir):
+    indexes, lit, image_index = illumination(dirname)
+    shape = image_shape(dirname, indexes)
+    box = centered_roi(shape, roi_size) if roi is None else roi
+    images = load_images(dirname, indexes, box)
+    size = images.shape[1]
+    if images.shape[1] != images.shape[2]:
+        raise ValueError("roi must be square, got {}".format(images.shape[1:]))
+    dx = pixel_size / magnification
+    offsets = box_offsets(lit, box, optical_axis(dirname, shape))
+    factor = needed_upsample(offsets, size) if upsample is None else upsample
+    pupil = circular_pupil(size, pupil_radius(size, dx))
+    print("reconstructing {} leds in {} images, {}x{} -> {}x{}".format(
+        len(lit), len(indexes), size, size, size * factor, size * factor))
+    obj, pupil = reconstruct(
+        images, offsets, pupil, factor, iterations, object_step, pupil_step,
+        callback=lambda i, spectrum, pupil: print("iteration {} done".format(i + 1)),
+        image_index=image_index)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tiff.imwrite(str(out_dir / "amplitude.tiff"), np.abs(obj).astype(np.float32))
+    tiff.imwrite(str(out_dir / "phase.tiff"), np.angle(obj).astype(np.float32))
+    np.save(out_dir / "pupil.npy", pupil)
+    print("wrote {}".format(out_dir))
+
+
+def tile_boxes(box, size, overlap):
+    """
+    (y0, y1, x0, x1) of square tiles covering box, neighbours sharing at
+    least overlap pixels. The last row/column of tiles is moved in to end
+    at the edge of box.
+    """
+    y0, y1, x0, x1 = box
+    if y1 - y0 < size or x1 - x0 < size:
+        raise ValueError("roi {} is smaller than a {}px tile".format(box, size))
+
+    def starts(lo, hi):
+        points = list(range(lo, hi - size, size - overlap))
+        return points + [hi - size]
+
+    return [(ty, ty + size, tx, tx + size)
+            for ty in starts(y0, y1) for tx in starts(x0, x1)]
+
+
+def feather(size, ramp):
+    """
+    (size, size) blending weight, rising linearly over ramp pixels from each
+    edge. Never 0, so the edge of the field still gets its tile.
+    """
+    edge = np.arange(size)
+    w = np.minimum(1, (np.minimum(edge, size - 1 - edge) + 1) / (ramp + 1))
+    return np.outer(w, w).astype(np.float32)
+
+
+def _reconstruct_tile(job):
+    dirname, indexes, lit, image_index, box, axis, factor = job
+    size = box[1] - box[0]
+    dx = pixel_size / magnification
+    images = load_images(dirname, indexes, box)
+    pupil = circular_pupil(size, pupil_radius(size, dx))
+    obj, pupil = reconstruct(images, box_offsets(lit, box, axis), pupil,
+                             factor, iterations, object_step, pupil_step,
+                             image_index=image_index)
+    return box, obj.astype(np.complex64), pupil
+
+
+def run_tiled(dirname, out_dir):
+    indexes, lit, image_index = illumination(dirname)
+    shape = image_shape(dirname, indexes)
+    box = (0, shape[0], 0, shape[1]) if roi is None else roi
+    tiles = tile_boxes(box, tile_size, tile_overlap)
+    axis = optical_axis(dirname, shape)
+    # one upsampling for every tile, so they line up
+    factor = upsample or max(needed_upsample(box_offsets(lit, tile, axis), tile_size)
+                             for tile in tiles)
+    out_shape = ((box[1] - box[0]) * factor, (box[3] - box[2]) * factor)
+    print("reconstructing {} leds in {} images, {} tiles of {}x{} -> {}x{}".format(
+        len(lit), len(indexes), len(tiles), tile_size, tile_size, *out_shape))
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    field = np.memmap(out_dir / "field.tmp", dtype=np.complex64, mode='w+', shape=out_shape)
+    weight = np.memmap(out_dir / "weight.tmp", dtype=np.float32, mode='w+', shape=out_shape)
+    blend = feather(tile_size * factor, tile_overlap * factor)
+    pupils = []
+
+    jobs = [(dirname, indexes, lit, image_index, tile, axis, factor) for tile in tiles]
+    with multiprocessing.Pool(tile_workers) as pool:
+        # in order, so every tile but the first overlaps one that's already placed
+        for i, (tile, obj, pupil) in enumerate(pool.imap(_reconstruct_tile, jobs)):
+            ys = slice((tile[0] - box[0]) * factor, (tile[1] - box[0]) * factor)
+            xs = slice((tile[2] - box[2]) * factor, (tile[3] - box[2]) * factor)
+            # each tile's global phase is arbitrary, match it to its neighbours
+            placed = weight[ys, xs] > 0
+            if placed.any():
+                obj *= np.exp(1j * np.angle(np.vdot(obj[placed], field[ys, xs][placed])))
+            field[ys, xs] += obj * blend
+            weight[ys, xs] += blend
+            pupils.append(pupil)
+            print("tile {}/{} done".format(i + 1, len(tiles)))
+
+    amplitude = tiff.memmap(str(out_dir / "amplitude.tiff"), shape=out_shape, dtype=np.float32)
+    phase = tiff.memmap(str(out_dir / "phase.tiff"), shape=out_shape, dtype=np.float32)
+    band = tile_size * factor
+    for y in range(0, out_shape[0], band):
+        obj = field[y:y + band] / weight[y:y + band]
+        amplitude[y:y + band] = np.abs(obj)
+        phase[y:y + band] = np.angle(obj)
+    amplitude.flush()
+    phase.flush()
+    del amplitude, phase, field, weight
+    (out_dir / "field.tmp").unlink()
+    (out_dir / "weight.tmp").unlink()
+    np.savez(out_dir / "pupils.npz", tiles=np.array(tiles), pupils=np.array(pupils))
+    print("wrote {}".format(out_dir))
+
+
+def simulate(obj, pupil, offsets, image_index=None):
+    """
+    low res images of a high res complex object (see test_reconstruct.py).
+    """
+    return forward(_fft(obj), pupil, offsets, pupil.shape[0], image_index)
+
+
+if __name__ == '__main__':
+    if tiled:
+        run_tiled(input_dir, output_dir)
+    else:
+        run(input_dir, output_dir)
@@ -28,6 +28,14 @@ from pathlib import Path
 from datetime import datetime
 import io
 import time
+import queue
+import threading
+import functools
+import zlib
+import re
+import itertools
+import json
+from collections import defaultdict
 
 import paramiko
 import requests
@@ -38,6 +46,12 @@ import png
 from PIL import Image
 import tifffile as tiff
 
+import packed_bayer
+import dataset
+import image_cleanup
+import tracing
+from receiver import PushReceiver
+
 # ================================== CONFIG ===================================
 host = 'uc2pi.attlocal.net'
 username = 'pi'
@@ -46,12 +60,66 @@ rsa_psk_path = '~/.ssh/uc2pi_key_rsa'
 remote_script_path = '/home/pi/UC2-FPM-software/rpi/run_fpm.py'# needs to be absolute
 remote_data_path = 'fpm_data'  # subdir of http server root
 
+# how do we find out about new captures on the pi?
+#  'mqtt':     subscribe to the FILE topic the capture script publishes to (fastest)
+#  'manifest': tail the manifest.txt the capture script appends to over http
+#  'html':     scrape the apache index page (slow, and loads the pi's cpu)
+#  'push':     the pi uploads every frame to us itself (set its upload_url to
+#              this machine and push_port) and deletes it once we have it,
+#              so a run isn't limited by the pi's sd card. see receiver.py.
+# the html scraper is used as a fallback when nothing is heard for a while
+# (except with 'push', where there's nothing left on the pi to scrape).
+file_discovery = 'mqtt'
+push_port = 8000
+mqtt_port = 1883
+mqtt_client_id = 'server'
+setup_id = 'FPMSCOPE'
+camera_id = 'CAMERA'
+manifest_name = 'manifest.txt'
+manifest_poll_interval = 0.05 # s, only used for 'manifest' discovery
+fallback_scrape_interval = 10  # s without any new file before scraping the index
+startup_delay = 5 # s to give the pi to clear its data dir before we look for files
+capture_extensions = ('.npy', '.pb12') # see raw_format in rpi/run_fpm.py
+
+# download options
+download_workers = 4       # long-lived download/convert processes
+max_pending_downloads = 16 # stop queueing new files once this many are waiting (backpressure)
+download_retries = 3       # extra attempts per file before giving up on it
+retry_backoff = 1          # s, doubled after every failed attempt
+download_timeout = 30      # s, connect/read timeout per request
+stream_downloads = True    # stream to disk in chunks (flat memory use, resumable) instead of into ram
+chunk_size = 1 << 20       # bytes, streaming chunk size
+verify_checksums = True    # check streamed files against the .crc sidecar written by the pi
+
 local_data_dir = '~/Documents/brake_2020_summer/data/fpm_data_{}'.format(
     datetime.today().strftime('%Y-%m-%d'))
 
 
-new_dataset = True # if false, don't run FPM, just use the files already on the pi
-#num_images = 5*64 # ONLY NEEDED WHEN ^^ IS FALSE: when can we stop processing?
+new_dataset = True # if false, don't run FPM, just fetch the files already on the pi
+# continue an interrupted run in local_data_dir instead of clearing it: whatever
+# is left on the pi is only downloaded if it isn't here yet (or doesn't match
+# the pi's checksum), and the capture script skips every (led, exposure) we have.
+resume = False
+received_name = 'received.txt' # "<capture> <size> <crc32>" for every capture stored locally
+remote_skip_path = '/tmp/fpm_skip.json' # see skip_list_path in rpi/run_fpm.py
+
+# write per-frame trace events (download, convert, load, process, ...) to
+# tracing.trace_name in local_data_dir, and fetch the pi's (if it traced too,
+# see trace in rpi/run_fpm.py) next to it. `python tracing.py <local_data_dir>`
+# turns them into a timing report.
+trace = False
+
+# 'dataset': write every frame (as a 2d mosaic) into one dataset container,
+#            see dataset.py. image_cleanup.py reads it lazily.
+# 'files':   one file per capture (.tiff for .npy captures, .pb12 stays packed)
+save_as = 'dataset'
+
+# process every led (demosaic, hdr / exposure selection, see image_cleanup.py
+# for those options and dest_dir) as soon as all of its exposures are here,
+# instead of running image_cleanup.py by hand after the run.
+process_while_capturing = True
+process_channel = 0 # 0 = red
+process_workers = 2
 
 # image processing options
 remove_dark_level = True # subtract dark_level from all pixels (or bring to 0)
@@ -71,7 +139,7 @@ def run_command(command, client, get_pty=True):
             print(stdoutLine, end="")
 
 
-def connect_and_run_command(host, username, rsa_psk_path, command):
+def connect_and_run_command(host, username, rsa_psk_path, command, files=None):
     # initialize ssh client
     client = paramiko.SSHClient()
     key = paramiko.RSAKey.from_private_key_file(
@@ -81,31 +149,280 @@ def connect_and_run_command(host, username, rsa_psk_path, command):
     transport = client.get_transport()
     transport.set_keepalive(1)  # keep it low (for a clean disconnect)
 
+    # {remote path: text} the command needs
+    if files:
+        sftp = client.open_sftp()
+        for remote_path, text in files.items():
+            with sftp.open(remote_path, 'w') as f:
+                f.write(text)
+        sftp.close()
+
     # run fpm script remotely
     run_command(command, client)
 
 
-def download_and_process(url, local_data_dir, name):
-    time.sleep(10) # make sure rpi cpu has time to flush io and all that just in case
+_session = None # one keep-alive session per download worker
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def fetch_sidecar(url, session):
+    """
+    (size, crc32) the pi wrote next to a capture, or None if there is none.
+    """
+    response = session.get(url + '.crc', timeout=download_timeout)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    size, crc = response.text.split()
+    return int(size), int(crc, 16)
+
+
+def stream_download(url, path, session):
+    """
+    stream url to path chunk by chunk, so the file never has to fit in memory.
+    If path already holds part of the file (e.g. the connection dropped), only
+    the rest is requested with an http range request.
+    """
+    path = Path(path)
+    offset = path.stat().st_size if path.exists() else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with session.get(url, headers=headers, stream=True,
+                     timeout=download_timeout) as response:
+        if response.status_code != 416: # 416: nothing left to fetch
+            response.raise_for_status()
+            # 200 means the server ignored the range, start over
+            with open(path, 'ab' if response.status_code == 206 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+    if verify_checksums:
+        sidecar = fetch_sidecar(url, session)
+        if sidecar is not None:
+            size, crc = sidecar
+            if path.stat().st_size != size or file_crc32(path) != crc:
+                path.unlink()
+                raise IOError("{} does not match its sidecar".format(path))
+
+
+def fetch_into_memory(url, session):
+    response = session.get(url, timeout=download_timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def with_retries(name, func, *args):
+    for attempt in range(download_retries + 1):
+        try:
+            return func(*args)
+        except IOError as e: # includes requests.RequestException
+            if attempt == download_retries:
+                raise
+            print("download of {} failed ({}), retrying...".format(name, e))
+            time.sleep(retry_backoff * 2 ** attempt)
+
+
+def subtract_dark_level(img_arr):
+    # in place, without a mask or any other temporary
+    np.subtract(np.maximum(img_arr, dark_level, out=img_arr), dark_level, out=img_arr)
+
+
+def parse_capture_name(name):
+    """
+    (led, exposure) from a capture name like img12_5000us.pb12
+    """
+    match = re.search(r"img(\d+)_(\d+)us", name)
+    return int(match.group(1)), int(match.group(2))
+
+
+def store_frame(local_data_dir, slot, name, mosaic, metadata):
+    """
+    write a frame into the dataset container and return what the main
+    process needs to add it to the index.
+    """
+    led, exposure = parse_capture_name(name)
+    dataset.write_frame(Path(local_data_dir).expanduser(), slot, mosaic)
+    height, width = mosaic.shape
+    return led, exposure, slot, dict(metadata, height=height, width=width)
+
+
+def download_and_process(url, local_data_dir, name, slot=None):
+    """
+    no need to wait for the pi to flush anything: a file is only announced
+    once its .done marker exists, i.e. after it was saved.
+
+    when streaming, the raw capture is kept next to the output until converted
+    and opened memory-mapped, so it never has to be copied into ram.
+    """
     print("url: {}\nlocal data dir: {}\nname: {}".format(url, local_data_dir, name))
-    raw_response = requests.get(url, stream=True).content
-    buf = io.BytesIO(raw_response)
-    img_arr = np.load(buf, allow_pickle=True)
-    if remove_dark_level:
-        img_arr[img_arr < dark_level] = dark_level
-        img_arr -= dark_level
-    #image_2d = np.reshape(img_arr, (-1, img_arr.shape[1] * 3))
-    #print(image_2d.shape)
     path = (Path(local_data_dir) / Path(name)).expanduser()
-    print('saving file: {}'.format(path))
-    with open(path, "wb") as f:
-        # for some reason Pillow can't open 16-bit RGB images.
-        # we have to combine chanels ourselves:
-        #red = Image.fromarray(img_arr[:, :, 0], mode="I;16").convert("L")
-        #green = Image.fromarray(img_arr[:, :, 1], mode="I;16").convert("L")
-        #blue = Image.fromarray(img_arr[:, :, 2], mode="I;16").convert("L")
-        #Image.merge("RGB", (red, green, blue)).save(path)
-        tiff.imwrite(path, img_arr)
+    raw_path = path.with_name(Path(url).name + '.part')
+    content = None
+    led, exposure = parse_capture_name(name)
+    with tracing.span('download', led=led, exposure=exposure) as span:
+        if stream_downloads:
+            with_retries(name, stream_download, url, raw_path, get_session())
+            span.set(bytes=raw_path.stat().st_size)
+        else:
+            content = with_retries(name, fetch_into_memory, url, get_session())
+            span.set(bytes=len(content))
+    return process_capture(raw_path, local_data_dir, name, slot, content)
+
+
+def capture_record(raw_path, content=None):
+    """
+    (capture name, size, crc32) of a capture as it came from the pi, for the
+    received list.
+    """
+    if content is None:
+        return raw_path.stem, raw_path.stat().st_size, file_crc32(raw_path)
+    return raw_path.stem, len(content), zlib.crc32(content)
+
+
+def process_capture(raw_path, local_data_dir, name, slot=None, content=None):
+    """
+    convert a capture that's at raw_path (removed afterwards), or in memory
+    as content.
+
+    .npy captures are converted to tiff, packed .pb12 captures are kept packed
+    (with the dark level removed), see packed_bayer.py. If a dataset slot is
+    given, the frame is written into the dataset container instead.
+
+    returns (capture_record(), frame), frame being the (led, exposure, slot,
+    metadata) to index a dataset frame with, or None.
+    """
+    led, exposure = parse_capture_name(name)
+    with tracing.span('convert', led=led, exposure=exposure) as span:
+        result = _convert_capture(Path(raw_path), local_data_dir, name, slot, content)
+        span.set(bytes=result[0][1])
+    return result
+
+
+def _convert_capture(raw_path, local_data_dir, name, slot, content):
+    path = (Path(local_data_dir) / Path(name)).expanduser()
+    record = capture_record(raw_path, content)
+    result = None
+    if Path(raw_path.stem).suffix == '.pb12': # name.pb12.part
+        if content is None:
+            header, mosaic = packed_bayer.read_packed(raw_path)
+        else:
+            header, mosaic = packed_bayer.loads_packed(content)
+        if remove_dark_level:
+            subtract_dark_level(mosaic)
+            header['dark_level'] = dark_level
+        if slot is not None:
+            del header['exposure'], header['height'], header['width']
+            result = store_frame(local_data_dir, slot, name, mosaic, header)
+        else:
+            print('saving file: {}'.format(path))
+            packed_bayer.write_packed(path, mosaic, header)
+    else:
+        if content is None:
+            img_arr = np.load(raw_path, mmap_mode='r+')
+        else:
+            img_arr = np.load(io.BytesIO(content), allow_pickle=True)
+        if remove_dark_level:
+            subtract_dark_level(img_arr)
+        # the mosaic alone doesn't say, the channels of the bayer array do
+        order = image_cleanup.bayer_order_of(img_arr)
+        if slot is not None:
+            # only one channel is nonzero per pixel, so this is the mosaic
+            mosaic = img_arr.sum(axis=2, dtype=np.uint16)
+            result = store_frame(local_data_dir, slot, name, mosaic,
+                                 {'dark_level': dark_level if remove_dark_level else 0,
+                                  'bayer_order': order})
+        else:
+            #image_2d = np.reshape(img_arr, (-1, img_arr.shape[1] * 3))
+            #print(image_2d.shape)
+            print('saving file: {}'.format(path))
+            with open(path, "wb") as f:
+                # for some reason Pillow can't open 16-bit RGB images.
+                # we have to combine chanels ourselves:
+                #red = Image.fromarray(img_arr[:, :, 0], mode="I;16").convert("L")
+                #green = Image.fromarray(img_arr[:, :, 1], mode="I;16").convert("L")
+                #blue = Image.fromarray(img_arr[:, :, 2], mode="I;16").convert("L")
+                #Image.merge("RGB", (red, green, blue)).save(path)
+                tiff.imwrite(path, img_arr, metadata={'bayer_order': order},
+                             **image_cleanup.tiff_options(img_arr))
+        del img_arr # close the memmap before removing its file
+    if content is None:
+        raw_path.unlink()
+    return record, result
+
+
+def read_received(dirname):
+    """
+    {capture name: (size, crc32)} of the captures that made it into dirname
+    (see received_name) and are still there.
+    """
+    path = Path(dirname) / received_name
+    if not path.exists():
+        return {}
+    received = {}
+    for line in path.read_text().splitlines():
+        fields = line.split()
+        if len(fields) == 3: # the last line may be cut off
+            received[fields[0]] = (int(fields[1]), int(fields[2], 16))
+    if save_as == 'dataset':
+        stored = dataset.FPMDataset(dirname) if dataset.is_dataset(dirname) else ()
+        return {name: record for name, record in received.items()
+                if parse_capture_name(name) in stored}
+    return {name: record for name, record in received.items()
+            if (Path(dirname) / local_name(name)).exists()}
+
+
+def record_received(dirname, name, size, crc):
+    with open(Path(dirname) / received_name, 'a') as f:
+        f.write("{} {} {:08x}\n".format(name, size, crc))
+
+
+def reconcile(host, remote_data_path, received):
+    """
+    the captures on the pi we still need: the ones we never received, and the
+    ones whose sidecar no longer matches what we have (captured again, or we
+    stored a bad copy).
+    """
+    url = 'http://' + host + '/' + remote_data_path + '/'
+    needed = []
+    for path in update_remote_file_list(host, remote_data_path):
+        if path not in received:
+            needed.append(path)
+        elif verify_checksums:
+            sidecar = fetch_sidecar(url + path, get_session())
+            if sidecar is not None and sidecar != received[path]:
+                needed.append(path)
+    return needed
+
+
+def read_local_run_info(dirname):
+    path = Path(dirname) / 'run_info.json'
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def skip_list(received, run_info):
+    """
+    what the capture script can skip (see skip_list_path in rpi/run_fpm.py):
+    every (led, exposure) we have, and, for adaptive exposure runs, the
+    exposures the pi picked for each led we have all of.
+    """
+    frames = set(parse_capture_name(name) for name in received)
+    led_exposures = {
+        led: exposures
+        for led, exposures in (run_info or {}).get('led_exposures', {}).items()
+        if all((int(led), exposure) in frames for exposure in exposures)}
+    return {'frames': sorted(frames), 'led_exposures': led_exposures}
 
 
 def update_remote_file_list(host, remote_data_path):
@@ -115,60 +432,584 @@ def update_remote_file_list(host, remote_data_path):
     all_paths = [node.get('href') for node in soup.find_all('a')]
     return [
         path for path in all_paths
-        if path.endswith('.npy')
-        and path.replace('.npy', '.done') in all_paths
+        if path.endswith(capture_extensions)
+        and str(Path(path).with_suffix('.done')) in all_paths
     ]
 
 
-def sync_new_files(host, remote_data_path, existing_paths, local_data_dir):
+def new_run_id():
+    return datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+
+def parse_file_event(event, run_id):
+    """
+    the capture announced in a manifest line or FILE message ("<run id>
+    <capture>"), or None if it's from another run (or not an announcement).
+    """
+    fields = event.split()
+    if len(fields) != 2 or fields[0] != run_id:
+        return None
+    return fields[1]
+
+
+def mqtt_client(mqtt):
+    """
+    a paho client with the (1.x style) callbacks used here, on paho 1.x and 2.x.
+    """
+    if hasattr(mqtt, 'CallbackAPIVersion'): # paho >= 2.0
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, mqtt_client_id)
+    return mqtt.Client(mqtt_client_id)
+
+
+def subscribe_file_events(host, port, topic, run_id, event_queue):
+    """
+    subscribe to the capture script's FILE topic, putting every file name
+    announced for run_id into event_queue. returns the (running) mqtt client,
+    or None if we can't listen for events, in which case only the fallback
+    scraper is used.
+    """
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        print("WARNING: paho-mqtt not installed, falling back to html index scraping")
+        return None
+
+    def on_message(client, userdata, message):
+        path = parse_file_event(message.payload.decode(), run_id)
+        if path is not None:
+            event_queue.put(path)
+
+    try:
+        client = mqtt_client(mqtt)
+        client.on_message = on_message
+        client.connect(host, port)
+    except (OSError, ValueError) as e: # ValueError: a paho version we don't know
+        print("WARNING: could not connect to mqtt broker ({}), falling back to "
+              "html index scraping".format(e))
+        return None
+    client.subscribe(topic, qos=1)
+    client.loop_start()
+    return client
+
+
+def wait_for_run(host, remote_data_path, run_id, stop_event):
+    """
+    block until the capture script of run_id is up, i.e. its run_info.json is
+    there. By then the data dir was cleared, so nothing in it is left over
+    from an earlier run. False if stop_event was set first.
+    """
+    url = 'http://' + host + '/' + remote_data_path + '/run_info.json'
+    with requests.Session() as session:
+        while not stop_event.is_set():
+            try:
+                response = session.get(url, timeout=download_timeout)
+                if response.status_code == 200 and response.json().get('run_id') == run_id:
+                    return True
+            except (requests.RequestException, ValueError):
+                pass # not up yet, or caught mid-write
+            stop_event.wait(manifest_poll_interval)
+    return False
+
+
+def watch_manifest(host, remote_data_path, run_id, event_queue, stop_event):
+    """
+    tail the capture manifest over http, only requesting the bytes appended
+    since the last poll, and put every file announced for run_id into
+    event_queue. If the manifest is restarted (shorter than what we've read,
+    or gone) it's read again from the start.
+    """
+    if not wait_for_run(host, remote_data_path, run_id, stop_event):
+        return
+    url = 'http://' + host + '/' + remote_data_path + '/' + manifest_name
+    offset = 0
+    with requests.Session() as session:
+        while not stop_event.is_set():
+            try:
+                response = session.get(url, headers={'Range': 'bytes={}-'.format(offset)},
+                                       timeout=download_timeout)
+            except requests.RequestException:
+                response = None
+            content = b''
+            if response is None:
+                pass
+            elif response.status_code in (404, 416):
+                # 416: the manifest is shorter than our offset, it was restarted.
+                # a range starting right at its end is a 416 too, so check the size
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                if response.status_code == 404 or not total.isdigit() or int(total) < offset:
+                    offset = 0
+            elif response.status_code == 200:
+                # server ignored the range (or the manifest was restarted)
+                if len(response.content) < offset:
+                    offset = 0
+                content = response.content[offset:]
+            elif response.status_code == 206:
+                content = response.content
+            # only consume complete lines, a write might be in progress
+            content = content[:content.rfind(b'\n') + 1]
+            offset += len(content)
+            for line in content.decode().splitlines():
+                path = parse_file_event(line, run_id)
+                if path is not None:
+                    event_queue.put(path)
+            stop_event.wait(manifest_poll_interval)
+
+
+class DownloadPool:
+    """
+    fixed number of long-lived worker processes that download and convert
+    files, each reusing one keep-alive http session. submit() blocks once
+    max_pending files are queued or in progress, so we never pile up more
+    work than the workers can keep up with.
+    """
+    def __init__(self, workers, max_pending, on_done=None):
+        self.pool = multiprocessing.Pool(workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.on_done = on_done # called (in this process) with every name, result
+        self.dataset_slots = itertools.count()
+        self.stored_slots = {} # (led, exposure): slot, of a resumed dataset's frames
+        self.max_pending = max_pending
+        self.failed = []
+
+    def submit(self, url, local_data_dir, name, slot=None):
+        self._apply(name, download_and_process, url, local_data_dir, name, slot)
+
+    def submit_local(self, raw_path, local_data_dir, name, slot=None):
+        """
+        like submit, for a capture that's already here (pushed by the pi).
+        """
+        self._apply(name, process_capture, raw_path, local_data_dir, name, slot)
+
+    def _apply(self, name, func, *args):
+        self.slots.acquire()
+        self.pool.apply_async(func, args,
+                              callback=functools.partial(self._done, name),
+                              error_callback=functools.partial(self._failed, name))
+
+    def _done(self, name, result):
+        # runs on the pool's result thread: if this raised, that thread would
+        # die and every later submit() and join() would block forever
+        try:
+            if self.on_done is not None:
+                self.on_done(name, result)
+        except Exception as e:
+            print("ERROR: could not finish {}: {}".format(name, e))
+            self.failed.append(name)
+        finally:
+            self.slots.release()
+
+    def _failed(self, name, e):
+        print("ERROR: giving up on {}: {}".format(name, e))
+        self.failed.append(name)
+        self.slots.release()
+
+    def wait(self):
+        """
+        block until everything submitted so far is done.
+        """
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        for _ in range(self.max_pending):
+            self.slots.release()
+
+    def join(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def fetch_run_info(host, remote_data_path):
+    """
+    the run_info.json the capture script writes when it starts (led count,
+    exposure times, gains), or None if there is none.
+    """
+    url = 'http://' + host + '/' + remote_data_path + '/run_info.json'
+    try:
+        response = get_session().get(url, timeout=download_timeout)
+    except requests.ConnectionError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def fetch_pi_trace(host, remote_data_path, dirname):
+    """
+    save the capture script's trace events (if it wrote any) next to ours.
+    """
+    url = 'http://' + host + '/' + remote_data_path + '/' + tracing.trace_name
+    try:
+        response = get_session().get(url, timeout=download_timeout)
+    except requests.ConnectionError:
+        return
+    if response.status_code == 200:
+        (Path(dirname) / tracing.pi_trace_name).write_bytes(response.content)
+
+
+def capture_metadata(run_info):
+    """
+    what the dataset container keeps from run_info.json. patterns lists the
+    leds lit in each frame (see multiplex in rpi/run_fpm.py), so with a
+    multiplexed capture "led" i in the dataset is really pattern i.
+    led_exposures lists the exposures each led was captured at, if the pi
+    picked them per led (see adaptive_exposure). roi is the [y0, y1, x0, x1]
+    part of the sensor (sensor_shape) the frames were cropped to.
+    """
+    keys = ('patterns', 'exposure_times', 'led_exposures', 'sensor_shape', 'roi')
+    return {key: run_info[key] for key in keys if key in run_info}
+
+
+def fetch_led_exposures(host, remote_data_path):
+    """
+    {led: exposures} of the leds the pi has finished so far, for adaptive
+    exposure runs (see adaptive_exposure in rpi/run_fpm.py).
+    """
+    run_info = fetch_run_info(host, remote_data_path) or {}
+    return {int(led): exposures
+            for led, exposures in run_info.get('led_exposures', {}).items()}
+
+
+def process_led(local_data_dir, pxl, exposures, response, run_exposures):
+    dirname = Path(local_data_dir).expanduser()
+    imgs = {}
+    with tracing.span('load', led=pxl):
+        image_cleanup.load_images(dirname, pxl, imgs)
+    with tracing.span('process', led=pxl):
+        img = image_cleanup.process_led(imgs[pxl], exposures, response, process_channel,
+                                        run_exposures, image_cleanup.saturation_level(dirname),
+                                        image_cleanup.get_bayer_order(dirname))
+    image_cleanup.write_image(pxl, img)
+
+
+class LedProcessor:
+    """
+    runs image_cleanup's processing for each led (on its own worker pool) as
+    soon as every one of its exposures has been downloaded, so the processed
+    dataset is done right after the capture instead of much later.
+
+    if the hdr response curve still has to be calibrated, leds wait until
+    image_cleanup.calibration_led is complete.
+
+    if the pi picks exposures per led, get_led_exposures() returns the
+    {led: exposures} it has decided so far; a led is complete once it has
+    been listed and all of its exposures are in.
+    """
+    def __init__(self, local_data_dir, exposures, workers, get_led_exposures=None):
+        self.local_data_dir = local_data_dir
+        self.exposures = sorted(exposures)
+        self.get_led_exposures = get_led_exposures
+        self.led_exposures = {}
+        self.pool = multiprocessing.Pool(workers)
+        self.received = defaultdict(set)
+        self.submitted = set()
+        self.waiting = [] # complete leds waiting for the response curve
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.calibration = None
+        self.response = None
+        if image_cleanup.run_hdr:
+            self.response = image_cleanup.get_response(
+                Path(local_data_dir).expanduser(), self.exposures, process_channel,
+                calibrate=False)
+        image_cleanup.dest_dir.mkdir(parents=True, exist_ok=True)
+        image_cleanup.write_capture_info(Path(local_data_dir).expanduser())
+
+    def expected(self, led):
+        """
+        the exposures led is captured at, None if the pi hasn't said yet.
+        """
+        if self.get_led_exposures is None:
+            return self.exposures
+        if led not in self.led_exposures:
+            self.led_exposures.update(self.get_led_exposures())
+        return self.led_exposures.get(led)
+
+    def frame_done(self, led, exposure):
+        self.received[led].add(exposure)
+        self._check(led)
+
+    def _check(self, led):
+        expected = self.expected(led)
+        if (led in self.submitted or expected is None
+                or not self.received[led].issuperset(expected)):
+            return
+        self.submitted.add(led)
+        with self.lock:
+            if image_cleanup.run_hdr and self.response is None:
+                self.waiting.append(led)
+                if led == image_cleanup.calibration_led:
+                    self.calibration = threading.Thread(target=self._calibrate)
+                    self.calibration.start()
+                return
+        self._submit(led)
+
+    def _calibrate(self):
+        response = image_cleanup.get_response(
+            Path(self.local_data_dir).expanduser(),
+            self.expected(image_cleanup.calibration_led), process_channel)
+        with self.lock:
+            self.response = response
+            waiting, self.waiting = self.waiting, []
+        for led in waiting:
+            self._submit(led)
+
+    def _submit(self, led):
+        print("all exposures of led {} are in, processing...".format(led))
+        self.jobs.append(self.pool.apply_async(
+            process_led, (self.local_data_dir, led, self.expected(led), self.response,
+                          self.exposures)))
+
+    def join(self):
+        for led in list(self.received): # leds the pi only listed after their last frame
+            self._check(led)
+        if self.calibration is not None:
+            self.calibration.join()
+        self.pool.close()
+        self.pool.join()
+        for job in self.jobs:
+            job.get() # raise any errors
+        if self.waiting:
+            print("WARNING: led {} never completed, so no response curve could be "
+                  "calibrated. run image_cleanup.py by hand.".format(
+                      image_cleanup.calibration_led))
+
+
+def local_name(path):
+    """
+    name a downloaded capture is saved under: .npy captures are converted to
+    tiff, packed ones stay packed.
+    """
+    return path.replace(".npy", ".tiff")
+
+
+def start_downloads(paths, host, remote_data_path, local_data_dir, pool, pushed=False):
+    for path in paths:
+        name = local_name(path)
+        slot = None
+        if save_as == 'dataset': # a frame fetched again goes back into its slot
+            slot = pool.stored_slots.get(parse_capture_name(name))
+            if slot is None:
+                slot = next(pool.dataset_slots)
+        if pushed: # already here
+            raw_path = Path(local_data_dir).expanduser() / (path + '.part')
+            pool.submit_local(raw_path, local_data_dir, name, slot)
+        else:
+            url = 'http://' + host + '/' + remote_data_path + '/' + path
+            pool.submit(url, local_data_dir, name, slot)
+
+
+def sync_new_files(host, remote_data_path, existing_paths, local_data_dir, pool):
     new_paths = update_remote_file_list(host, remote_data_path)
-    jobs = []
-    for path in list(set(new_paths) - set(existing_paths)):
-        name = path.replace(".npy", ".tiff")
-        url = 'http://' + host + '/' + remote_data_path + '/' + path
-        job = multiprocessing.Process(target=download_and_process,
-                                      args=(url, local_data_dir, name))
-        jobs.append(job)
-        job.start()
-    return new_paths, jobs
+    start_downloads(list(set(new_paths) - set(existing_paths)),
+                    host, remote_data_path, local_data_dir, pool)
+    return new_paths
+
+
+def next_new_files(events, host, remote_data_path):
+    """
+    block until the capture script announces a file. If nothing shows up in
+    fallback_scrape_interval, scrape the html index instead (in case an event
+    got lost, or there's no event source at all).
+    """
+    try:
+        paths = [events.get(timeout=fallback_scrape_interval)]
+    except queue.Empty:
+        if file_discovery == 'push':
+            return []
+        return update_remote_file_list(host, remote_data_path)
+    while True: # grab anything else that is already waiting
+        try:
+            paths.append(events.get_nowait())
+        except queue.Empty:
+            return paths
 
 
 def main():
     print("using remote_script_path: \"{}\"".format(remote_script_path))
-    command = "rm /var/www/{}/*; {}".format(remote_data_path, remote_script_path)
-
-    if new_dataset:
-        # run the script and wait until completion (show log info)
-        ssh_proc = multiprocessing.Process(target=connect_and_run_command,
-                                           args=(
-                                               host,
-                                               username,
-                                               rsa_psk_path,
-                                               command,
-                                           ))
-        ssh_proc.start()
+
+    dataset_dir = Path(local_data_dir).expanduser()
+    received = {}
+    if resume and dataset_dir.exists():
+        received = read_received(dataset_dir)
+        print("resuming, {} captures already here".format(len(received)))
     else:
-        print("new_dataset false, using existing files...")
+        try:
+            os.mkdir(dataset_dir)
+        except FileExistsError:
+            print("WARNING: local data dir already exists. deleteing...")
+            for path in dataset_dir.glob('*'):
+                print("deleting: {}".format(path))
+                os.unlink(path)
+    if trace: # before any worker is forked, they all write to the same file
+        tracing.enable(dataset_dir / tracing.trace_name)
+    paths = set()
+    processor = None
+    started = False
+    receiver = None
+
+    def start_run():
+        # once the first captures show up, run_info.json is there too
+        nonlocal processor, started
+        started = True
+        run_info = fetch_run_info(host, remote_data_path)
+        if run_info is None and resume:
+            run_info = read_local_run_info(dataset_dir) # the pi was cleared already
+        if run_info is None:
+            print("WARNING: no run_info.json on the pi, can't process while capturing")
+        else:
+            # kept next to the captures, image_cleanup reads the led patterns and roi from it
+            (dataset_dir / 'run_info.json').write_text(json.dumps(run_info))
+        if save_as == 'dataset':
+            if resume and dataset.is_dataset(dataset_dir):
+                stored = dataset.FPMDataset(dataset_dir)
+                pool.dataset_slots = itertools.count(len(stored.frames))
+                pool.stored_slots = dict(stored.slots)
+            else:
+                dataset.create_dataset(dataset_dir, **capture_metadata(run_info or {}))
+        if run_info is not None and process_while_capturing:
+            get_led_exposures = None
+            if run_info.get('adaptive_exposure'):
+                get_led_exposures = functools.partial(fetch_led_exposures, host,
+                                                      remote_data_path)
+            with processor_lock: # finish_captures may be adding frames already
+                processor = LedProcessor(local_data_dir, run_info['exposure_times'],
+                                         process_workers, get_led_exposures)
+                for name in list(received):
+                    processor.frame_done(*parse_capture_name(name))
+
+    finished = queue.Queue() # (name, result) of every converted capture
+    processor_lock = threading.Lock()
 
-    time.sleep(5) # give the pi some time to delete files first
-    # look for new files @ http://hostname/fpm_data, download and process
+    def finish_captures():
+        """
+        index every converted capture in the dataset container, record it as
+        received and hand it to the led processor. Done here and not in the
+        download pool's callback, which runs on the pool's result thread:
+        this blocks on disk and http, and may raise.
+        """
+        while True:
+            item = finished.get()
+            if item is None:
+                finished.task_done()
+                return
+            name, (record, frame) = item
+            try:
+                if save_as == 'dataset':
+                    dataset.add_frame(dataset_dir, *frame[:3], **frame[3])
+                record_received(dataset_dir, *record)
+                received[record[0]] = record[1:]
+            except Exception as e:
+                print("ERROR: could not store {}: {}".format(name, e))
+                pool.failed.append(name)
+                finished.task_done()
+                continue
+            try:
+                with processor_lock:
+                    if processor is not None:
+                        processor.frame_done(*parse_capture_name(name))
+            except Exception as e: # its led is checked again at the end
+                print("WARNING: could not check the led of {} ({})".format(name, e))
+            finished.task_done()
+
+    finisher = threading.Thread(target=finish_captures)
+    finisher.start()
+    # always stopped, or an error anywhere below would leave it (and the
+    # process) waiting for captures forever
     try:
-        os.mkdir(Path(local_data_dir).expanduser())
-    except FileExistsError:
-        print("WARNING: local data dir already exists. deleteing...")
-        for path in Path(local_data_dir).expanduser().glob('*'):
-            print("deleting: {}".format(path))
-            os.unlink(path)
-    paths = []
-    jobs = []
-    while ssh_proc.is_alive() if new_dataset else len(paths) < num_images:
-        paths, newjobs = sync_new_files(host, remote_data_path, paths, local_data_dir)
-        jobs.extend(newjobs)
-    # run one more time once the script is complete to deal with last file
-    paths, newjobs = sync_new_files(host, remote_data_path, paths, local_data_dir)
-    jobs.extend(newjobs)
-    for job in jobs:
-        job.join()
+        pool = DownloadPool(download_workers, max_pending_downloads,
+                            on_done=lambda name, result: finished.put((name, result)))
+        if resume or not new_dataset:
+            # whatever is still on the pi, before the capture script clears it
+            start_run()
+            needed = reconcile(host, remote_data_path, received)
+            print("fetching {} captures from the pi...".format(len(needed)))
+            start_downloads(needed, host, remote_data_path, local_data_dir, pool)
+            pool.wait()
+            finished.join()
+
+        if new_dataset:
+            # start listening before the capture starts, so no announcement is missed
+            events = queue.Queue()
+            listener = None
+            stop_watching = threading.Event()
+            # the capture script tags its announcements with this, so anything left
+            # over from an earlier run (a stale manifest, a late message) is ignored
+            run_id = new_run_id()
+            if file_discovery == 'mqtt':
+                topic = '/{}/{}/FILE'.format(setup_id, camera_id)
+                listener = subscribe_file_events(host, mqtt_port, topic, run_id, events)
+            elif file_discovery == 'manifest':
+                threading.Thread(target=watch_manifest,
+                                 args=(host, remote_data_path, run_id, events, stop_watching),
+                                 daemon=True).start()
+
+            command = "rm /var/www/{}/*; FPM_RUN_ID={} {}".format(
+                remote_data_path, run_id, remote_script_path)
+            # always written, so a skip list from an earlier resume is never reused
+            skip = json.dumps(skip_list(received, read_local_run_info(dataset_dir)))
+
+            # run the script and wait until completion (show log info)
+            ssh_proc = multiprocessing.Process(target=connect_and_run_command,
+                                               args=(
+                                                   host,
+                                                   username,
+                                                   rsa_psk_path,
+                                                   command,
+                                                   {remote_skip_path: skip},
+                                               ))
+            ssh_proc.start()
+
+            time.sleep(startup_delay)
+            if file_discovery == 'push':
+                # the pi keeps retrying its uploads until we're listening
+                receiver = PushReceiver(push_port, dataset_dir, events.put).start()
+
+            # look for new files @ http://hostname/fpm_data, download and process
+            pushed = file_discovery == 'push'
+            while ssh_proc.is_alive():
+                new_paths = set(next_new_files(events, host, remote_data_path)) - paths
+                if new_paths and not started:
+                    start_run()
+                start_downloads(new_paths, host, remote_data_path, local_data_dir, pool, pushed)
+                paths.update(new_paths)
+            if not started:
+                start_run()
+            if pushed:
+                # the capture script only exits once everything was pushed, stop()
+                # waits for the last uploads to be handed over
+                receiver.stop()
+                new_paths = set()
+                while not events.empty():
+                    new_paths.add(events.get())
+                start_downloads(new_paths - paths, host, remote_data_path, local_data_dir,
+                                pool, pushed)
+                paths.update(new_paths)
+            else:
+                # run one more time once the script is complete to deal with last file
+                paths.update(sync_new_files(host, remote_data_path, paths, local_data_dir, pool))
+            stop_watching.set()
+            if listener is not None:
+                listener.loop_stop()
+                listener.disconnect()
+        else:
+            print("new_dataset false, only used the files already on the pi")
+        pool.join()
+    finally:
+        finished.put(None)
+        finisher.join()
+    # the pi keeps adding to run_info.json while capturing (e.g. led_exposures)
+    run_info = fetch_run_info(host, remote_data_path)
+    if run_info is not None:
+        (dataset_dir / 'run_info.json').write_text(json.dumps(run_info))
+        if save_as == 'dataset':
+            dataset.update_metadata(dataset_dir, **capture_metadata(run_info))
+    if processor is not None:
+        processor.join()
+    if trace:
+        tracing.disable()
+        fetch_pi_trace(host, remote_data_path, dataset_dir)
+    if pool.failed:
+        print("WARNING: {} files could not be downloaded or stored:".format(len(pool.failed)))
+        [print(name) for name in sorted(pool.failed)]
     print("all files processed. exiting...")
 
     
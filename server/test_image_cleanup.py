@@ -0,0 +1,62 @@
+"""
+checks of image_cleanup's numpy hdr merge on synthetic data. Run with
+pytest from this directory.
+"""
+import numpy as np
+
+import image_cleanup
+
+saturation = 2 ** 12 - 1 - 256 # 12-bit sensor, dark level subtracted
+exposures = [1000, 10000, 100000] # us
+
+
+def expose(radiance):
+    """
+    (led, exposure, height, width) frames of a linear sensor, radiance in
+    counts per second.
+    """
+    return np.stack([np.minimum(np.round(radiance * e / 1e6), saturation)
+                     for e in exposures], axis=1).astype(np.uint16)
+
+
+def test_merge_recovers_radiance_with_saturated_frames():
+    rng = np.random.default_rng(0)
+    radiance = rng.uniform(5e4, 3e6, size=(2, 32, 32))
+    stack = expose(radiance)
+    assert (stack[:, -1] == saturation).all() # the longest exposure is useless
+    merged = image_cleanup.merge_hdr_stack(stack, exposures,
+                                           image_cleanup.linear_response(4096), saturation)
+    np.testing.assert_allclose(merged, radiance, rtol=0.02)
+
+
+def test_merge_of_fully_saturated_pixels_is_a_lower_bound():
+    radiance = np.full((1, 4, 4), 1e8)
+    merged = image_cleanup.merge_hdr_stack(expose(radiance), exposures,
+                                           image_cleanup.linear_response(4096), saturation)
+    assert np.isfinite(merged).all()
+    # full scale: the last unsaturated value at the shortest exposure
+    np.testing.assert_allclose(merged, (saturation - 1) / (min(exposures) / 1e6), rtol=1e-5)
+
+
+def test_calibrated_merge_is_monotonic():
+    rng = np.random.default_rng(1)
+    radiance = np.exp(rng.uniform(np.log(1e3), np.log(1e7), size=(1, 64, 64)))
+    stack = expose(radiance)
+    response = image_cleanup.calibrate_response(stack[0], exposures, 4096,
+                                                saturation=saturation)
+    assert (response[saturation:] == response[saturation - 1]).all()
+    merged = image_cleanup.merge_hdr_stack(stack, exposures, response, saturation)
+    out = image_cleanup.radiance_to_uint16(merged, exposures, response, saturation).ravel()
+    assert (np.diff(out[np.argsort(radiance, axis=None)].astype(np.int64)) >= 0).all()
+    # only pixels saturated even at the shortest exposure clip
+    saturated = stack[:, 0].ravel() == saturation
+    assert saturated.any()
+    assert (out[saturated] == 65535).all()
+    assert (out[~saturated] < 65535).all()
+
+
+def test_saturated_values_get_no_weight():
+    w = image_cleanup.hdr_weights(4096, saturation)
+    assert (w[saturation:] == 0).all()
+    assert (w[:saturation] > 0).all()
+    assert np.argmax(w) == (saturation - 1) // 2
@@ -0,0 +1,94 @@
+"""
+reconstruct.py on simulated, seeded objects: the recovered amplitude and
+phase have to be close to the truth, in the batched (one roi) and the tiled
+mode. Run with pytest from this directory.
+"""
+import numpy as np
+import pytest
+import tifffile as tiff
+
+import reconstruct
+
+
+def smooth_object(size, seed):
+    """
+    (size, size) complex object with smooth random amplitude (0.2 - 1) and
+    phase (within +-pi/2).
+    """
+    rng = np.random.default_rng(seed)
+    smooth = lambda a: np.real(reconstruct._ifft(
+        reconstruct._fft(a) * reconstruct.circular_pupil(size, size / 8)))
+    amplitude = 0.6 + 0.4 * np.tanh(smooth(rng.standard_normal((size, size))))
+    phase = np.pi / 2 * np.tanh(smooth(rng.standard_normal((size, size))))
+    return (amplitude * np.exp(1j * phase)).astype(np.complex64)
+
+
+def errors(recovered, obj):
+    """
+    relative amplitude error and rms phase error (rad), ignoring the
+    arbitrary global phase.
+    """
+    recovered = recovered * np.exp(-1j * np.angle(np.vdot(obj, recovered)))
+    amplitude = (np.linalg.norm(np.abs(recovered) - np.abs(obj))
+                 / np.linalg.norm(np.abs(obj)))
+    phase = np.sqrt(np.mean(np.angle(recovered * np.conj(obj)) ** 2))
+    return amplitude, phase
+
+
+@pytest.mark.parametrize('multiplex', [1, 2])
+def test_batched(multiplex):
+    # 5x5 leds, imaged through a defocused pupil, recovered from an ideal one
+    size, upsample = 64, 3
+    obj = smooth_object(size * upsample, seed=0)
+    grid = np.arange(-2, 3)
+    offsets = np.stack(np.meshgrid(grid, grid, indexing='ij'), -1).reshape(-1, 2) * size // 8
+    radius = size / 5
+    ideal = reconstruct.circular_pupil(size, radius)
+    y, x = np.indices((size, size)) - size // 2
+    defocus = np.exp(1j * 1.5 * (x ** 2 + y ** 2) / radius ** 2)
+    image_index = None
+    if multiplex > 1: # the outer leds share images
+        outer = np.abs(offsets).max(axis=1) > size // 8
+        frames = -(-outer.sum() // multiplex)
+        image_index = np.arange(len(offsets))
+        image_index[~outer] = np.arange((~outer).sum())
+        image_index[outer] = (~outer).sum() + np.arange(outer.sum()) % frames
+    images = reconstruct.simulate(obj, ideal * defocus, offsets, image_index)
+
+    recovered, _ = reconstruct.reconstruct(images, offsets, ideal, upsample, 30,
+                                           image_index=image_index)
+    amplitude, phase = errors(recovered, obj)
+    assert amplitude < 0.12
+    assert phase < 0.12
+
+
+def test_tiled(tmp_path, monkeypatch):
+    # geometry where every tile sees the same (integer) spectrum offsets, so
+    # the whole field can be simulated at once
+    config = dict(led_ncols=5, led_count=25, led_center=(2, 2), led_pitch=4e-3,
+                  led_distance=60e-3, wavelength=630e-9, NA=0.1, magnification=4,
+                  pixel_size=4e-6, roi=None, leds=None, iterations=30,
+                  tile_size=64, tile_overlap=32, tile_workers=2)
+    for name, value in config.items():
+        monkeypatch.setattr(reconstruct, name, value)
+    field, tile = 128, 64
+    dx = reconstruct.pixel_size / reconstruct.magnification
+    leds = range(reconstruct.led_count)
+    offsets = reconstruct.spectrum_offsets(reconstruct.led_spatial_frequencies(leds), tile, dx)
+    for box in reconstruct.tile_boxes((0, field, 0, field), tile, reconstruct.tile_overlap):
+        assert (reconstruct.box_offsets(leds, box, (field / 2, field / 2)) == offsets).all()
+    upsample = reconstruct.needed_upsample(offsets, tile)
+    monkeypatch.setattr(reconstruct, 'upsample', upsample)
+
+    obj = smooth_object(field * upsample, seed=0)
+    pupil = reconstruct.circular_pupil(field, reconstruct.pupil_radius(field, dx))
+    images = reconstruct.simulate(obj, pupil, offsets * (field // tile))
+    for i, img in enumerate(images):
+        tiff.imwrite(str(tmp_path / "img{}.tiff".format(i)), img.astype(np.float32))
+
+    reconstruct.run_tiled(tmp_path, tmp_path / "out")
+    recovered = (tiff.imread(str(tmp_path / "out" / "amplitude.tiff"))
+                 * np.exp(1j * tiff.imread(str(tmp_path / "out" / "phase.tiff"))))
+    amplitude, phase = errors(recovered, obj)
+    assert amplitude < 0.07
+    assert phase < 0.12
@@ -0,0 +1,42 @@
+"""
+run_fpm.py against a fake pi (benchmark.py's web server and captures).
+Run with pytest from this directory.
+"""
+import numpy as np
+
+import benchmark
+import dataset
+import run_fpm
+
+exposures = [1000, 5000]
+leds = 4
+
+
+def test_resume_keeps_one_entry_per_frame(tmp_path, monkeypatch):
+    monkeypatch.setattr(benchmark, 'image_size', (64, 96))
+    web_root = tmp_path / 'www'
+    benchmark.write_captures(web_root / run_fpm.remote_data_path, leds, exposures)
+    local_dir = tmp_path / 'local'
+    monkeypatch.setattr(run_fpm, 'local_data_dir', str(local_dir))
+    monkeypatch.setattr(run_fpm, 'new_dataset', False) # only fetch what's on the pi
+    monkeypatch.setattr(run_fpm, 'save_as', 'dataset')
+    with benchmark.web_server(web_root) as host:
+        monkeypatch.setattr(run_fpm, 'host', host)
+        run_fpm.main()
+        # interrupted after the last frames were indexed, before they were
+        # recorded as received: resuming fetches them again
+        received = (local_dir / run_fpm.received_name).read_text().splitlines()
+        (local_dir / run_fpm.received_name).write_text("\n".join(received[:3]) + "\n")
+        size = (local_dir / dataset.data_name).stat().st_size
+        first = dataset.FPMDataset(local_dir)
+        stored = {key: np.array(first.frame(*key)) for key in first.slots}
+        monkeypatch.setattr(run_fpm, 'resume', True)
+        run_fpm.main()
+
+    meta = dataset.FPMDataset(local_dir).meta
+    frames = [(led, exposure) for led, exposure, _ in meta['frames']]
+    assert sorted(frames) == sorted((led, e) for led in range(leds) for e in exposures)
+    assert (local_dir / dataset.data_name).stat().st_size == size
+    resumed = dataset.FPMDataset(local_dir)
+    for key, frame in stored.items():
+        assert np.array_equal(resumed.frame(*key), frame)
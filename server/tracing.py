@@ -0,0 +1,213 @@
+"""
+Per-frame trace events, to find out where the time of a run goes (led acks,
+exposures, saving, transfer, demosaicing, hdr, ...).
+
+Every event is one json line: the stage, its start and end (unix time, s),
+the led and exposure it belongs to (or the leds of a whole chunk) and, where
+it makes sense, the bytes it moved. Events are appended with a single
+unbuffered write, so the worker processes forked after enable() can all write
+to the same file. While tracing is off, span() hands back a shared no-op, so
+leaving the calls in costs next to nothing.
+
+The capture script writes the same events on the pi (see trace in
+rpi/run_fpm.py), which server/run_fpm.py fetches as trace_pi.jsonl. Both clocks
+should be synced (ntp) for the critical path to be meaningful.
+
+    python tracing.py <run dir or trace files...>
+
+joins them into per-stage latency percentiles, throughput and a critical path
+breakdown of the run.
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+trace_name = 'trace.jsonl'
+pi_trace_name = 'trace_pi.jsonl'
+
+_fd = None
+
+
+def enable(path):
+    global _fd
+    disable()
+    _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+
+def disable():
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+
+
+def enabled():
+    return _fd is not None
+
+
+def event(stage, start, end=None, **fields):
+    if _fd is None:
+        return
+    fields.update(stage=stage, start=start, end=time.time() if end is None else end)
+    os.write(_fd, (json.dumps(fields) + '\n').encode())
+
+
+class _Span:
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+
+    def set(self, **fields):
+        """
+        add fields only known once the stage is done (e.g. bytes).
+        """
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        event(self.stage, self.start, **self.fields)
+
+
+class _NullSpan:
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(stage, **fields):
+    """
+    with span('download', led=3, exposure=1000) as s: ... s.set(bytes=n)
+    """
+    return _null_span if _fd is None else _Span(stage, fields)
+
+
+def load_events(paths):
+    """
+    every event in paths (trace files, or run dirs holding trace*.jsonl).
+    """
+    events = []
+    for path in map(Path, paths):
+        files = sorted(path.glob('trace*.jsonl')) if path.is_dir() else [path]
+        for trace_path in files:
+            for line in trace_path.read_text().splitlines():
+                if line.endswith('}'): # a writer may have been killed mid line
+                    events.append(json.loads(line))
+    return events
+
+
+def busy_time(starts, ends):
+    """
+    length of the union of the [start, end] intervals, i.e. how long at least
+    one of them was running.
+    """
+    order = np.argsort(starts)
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    gaps = np.maximum(starts[1:] - reach[:-1], 0)
+    return reach[-1] - starts[0] - gaps.sum()
+
+
+def stage_stats(events):
+    """
+    {stage: stats} of every stage's count, latency percentiles (s), bytes,
+    busy time (s, parallel runs count once) and throughput (while busy).
+    """
+    by_stage = {}
+    for e in events:
+        by_stage.setdefault(e['stage'], []).append(e)
+    stats = {}
+    for stage, stage_events in by_stage.items():
+        starts = np.array([e['start'] for e in stage_events])
+        ends = np.array([e['end'] for e in stage_events])
+        durations = ends - starts
+        busy = busy_time(starts, ends)
+        nbytes = sum(e.get('bytes', 0) for e in stage_events)
+        p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+        stats[stage] = {
+            'count': len(stage_events), 'p50': p50, 'p90': p90, 'p99': p99,
+            'max': durations.max(), 'total': durations.sum(), 'busy': busy,
+            'bytes': nbytes,
+            'events_per_s': len(stage_events) / busy if busy else float('inf'),
+            'bytes_per_s': nbytes / busy if busy else float('inf'),
+        }
+    return stats
+
+
+def _leds(e):
+    return {e['led']} if 'led' in e else set(e.get('leds', ()))
+
+
+def _related(a, b):
+    if not _leds(a) & _leds(b):
+        return False
+    return 'exposure' not in a or 'exposure' not in b or a['exposure'] == b['exposure']
+
+
+def critical_path(events):
+    """
+    the chain of stages that finished last: from the event that ended last,
+    repeatedly step back to the latest-ending event of the same frame (or
+    led) that started before it. Started-before rather than ended-before, so
+    a little clock skew between the pi and the server doesn't cut the chain.
+    """
+    events = [e for e in events if _leds(e)]
+    if not events:
+        return []
+    current = max(events, key=lambda e: e['end'])
+    path = [current]
+    while True:
+        earlier = [e for e in events
+                   if e['start'] < current['start'] and _related(e, current)]
+        if not earlier:
+            return path[::-1]
+        current = max(earlier, key=lambda e: e['end'])
+        path.append(current)
+
+
+def report(events):
+    if not events:
+        return "no trace events"
+    t0 = min(e['start'] for e in events)
+    wall = max(e['end'] for e in events) - t0
+    lines = ["{} events over {:.2f} s".format(len(events), wall), "",
+             "{:<12} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8} {:>8}".format(
+                 'stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+                 'busy %', '1/s', 'MB/s')]
+    stats = stage_stats(events)
+    for stage, s in sorted(stats.items(), key=lambda item: -item[1]['busy']):
+        lines.append("{:<12} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7.1f} {:>8.1f} {:>8}".format(
+            stage, s['count'], 1e3 * s['p50'], 1e3 * s['p90'], 1e3 * s['p99'],
+            1e3 * s['max'], 100 * s['busy'] / wall if wall else 100, s['events_per_s'],
+            "{:.1f}".format(s['bytes_per_s'] / 1e6) if s['bytes'] else '-'))
+    path = critical_path(events)
+    if path:
+        lines += ["", "critical path (the frame that finished last):",
+                  "{:>9} {:>9} {:>9}  stage".format('at s', 'took ms', 'wait ms')]
+        previous_end = t0
+        for e in path:
+            frame = ", ".join("{} {}".format(key, e[key])
+                              for key in ('led', 'leds', 'exposure') if key in e)
+            lines.append("{:>9.3f} {:>9.1f} {:>9.1f}  {} ({})".format(
+                e['start'] - t0, 1e3 * (e['end'] - e['start']),
+                1e3 * max(e['start'] - previous_end, 0), e['stage'], frame))
+            previous_end = max(previous_end, e['end'])
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    print(report(load_events(sys.argv[1:] or ['.'])))